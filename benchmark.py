@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for importpics.
+
+    copy    compares the fastcopy backends on large files, like the 40-60MB NEF
+            files and the bigger video files a camera writes
+    e2e     generates a synthetic card (see synthcard.py) and times each phase
+            of an import separately: all_pics, grouping, schedule_copy and
+            try_copy.  The planning and copying options of importpics can be
+            passed to compare engines.
+    order   generates a synthetic card written in a random order (so the data
+            of the pictures isn't in name order on the disk) and copies it
+            once in the order it was planned and once in physical order
+            (--copy-order), from a cold page cache each time.  Use --dir to
+            put the card on the disk or card to measure.
+    memory  plans the import of a synthetic archive of --files files (nothing
+            is written to disk, only the FileGroups and the CopyPlan are
+            built, the way an import holds them) and reports the peak RSS.
+
+The results are printed, and can also be written as JSON with --json.
+"""
+
+# STL
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+# PROJ
+import diskutil
+import fastcopy
+import importpics
+import synthcard
+
+MB = 1024 * 1024
+
+
+def make_file(path, size):
+    """
+    Writes a file of random (so incompressible) data
+    """
+    block = os.urandom(MB)
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            written += f.write(block[:min(MB, size - written)])
+
+
+def drop_cache(path):
+    """
+    Asks the kernel to forget the cached pages of a file, so the next read
+    comes from the disk.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def bench_copy(folder, sizes_mb, count, backends, fsync):
+    """
+    Copies `count` files of each size with each backend.
+    :returns: list of result dictionaries
+    """
+    results = []
+    for size_mb in sizes_mb:
+        srcs = []
+        for i in range(count):
+            src = os.path.join(folder, "SRC_{}_{:04d}.NEF".format(size_mb, i))
+            make_file(src, size_mb * MB)
+            srcs.append(src)
+
+        for backend in backends:
+            elapsed = 0.0
+            for src in srcs:
+                dst = src + "." + backend
+                drop_cache(src)
+                start = time.perf_counter()
+                fastcopy.copy(src, dst, backend)
+                if fsync:
+                    fd = os.open(dst, os.O_RDONLY)
+                    os.fsync(fd)
+                    os.close(fd)
+                elapsed += time.perf_counter() - start
+                os.remove(dst)
+            results.append({
+                "benchmark": "copy",
+                "backend": backend,
+                "file_mb": size_mb,
+                "files": count,
+                "seconds": elapsed,
+                "mb_per_sec": size_mb * count / elapsed if elapsed else None,
+            })
+
+        for src in srcs:
+            os.remove(src)
+    return results
+
+
+def drop_card_cache(files):
+    for f in files:
+        drop_cache(f)
+
+
+def bench_e2e(folder, args):
+    """
+    Imports a synthetic card into an empty destination, timing each phase.
+    :returns: list of result dictionaries, one per phase
+    """
+    card = os.path.join(folder, "card")
+    dest = os.path.join(folder, "dest")
+    logs = os.path.join(folder, "logs")
+    os.makedirs(dest)
+    files = synthcard.make_card(card, pictures=args.pictures, per_folder=args.per_folder,
+        jpeg_bytes=args.jpeg_kb * 1024, nef_bytes=args.nef_kb * 1024, raw=not args.no_raw,
+        days=args.days, cameras=args.cameras)
+    synthcard.make_collisions(dest, files, lambda f: importpics.picture_info(f)[0], args.collisions)
+    card_bytes = sum(os.path.getsize(f) for f in files)
+
+    metrics = importpics.Metrics()
+    copyplan = importpics.CopyPlan(lookback_days=args.days + 1)
+    copyplan.destpath = dest
+    copyplan.start_disk_avail = diskutil.avail_space(dest)
+    copyplan.copy_backend = args.copy_backend
+    copyplan.hash_algorithm = args.hash
+    copyplan.journal = args.journal
+    copyplan.clone = args.clone
+    copyplan.max_read_mbps = args.max_read_mbps
+    copyplan.max_write_mbps = args.max_write_mbps
+    copyplan.idle_io = args.idle_io
+    copyplan.drop_cache = args.drop_cache
+
+    results = []
+    def phase(name, seconds, files, nbytes = None):
+        results.append({
+            "benchmark": "e2e",
+            "phase": name,
+            "seconds": seconds,
+            "files": files,
+            "bytes": nbytes,
+            "files_per_sec": files / seconds if seconds else None,
+            "mb_per_sec": nbytes / MB / seconds if nbytes and seconds else None,
+        })
+
+    drop_card_cache(files)
+    start = time.perf_counter()
+    pics = importpics.all_pics(card)
+    phase("all_pics", time.perf_counter() - start, len(pics))
+
+    start = time.perf_counter()
+    groups = collections.defaultdict(importpics.FileGroup)
+    for p in pics:
+        groups[importpics.FileGroup.basepath(p)].append(p)
+    phase("grouping", time.perf_counter() - start, len(pics))
+
+    drop_card_cache(files)
+    start = time.perf_counter()
+    walked = list(importpics.walk_groups(card))
+    phase("walk_groups", time.perf_counter() - start, sum(len(fg.files) for fg in walked))
+
+    with importpics.CopyLog.load(logs) as copylog:
+        drop_card_cache(files)
+        start = time.perf_counter()
+        importpics.schedule_all(metrics, copyplan, copylog, walked, args.jobs)
+        phase("schedule_copy", time.perf_counter() - start, len(files))
+
+        drop_card_cache(files)
+        start = time.perf_counter()
+        importpics.copy_all(metrics, copyplan, copylog, args.copy_jobs)
+        phase("try_copy", time.perf_counter() - start, metrics.copied, copyplan.bytes_to_copy)
+
+    for r in results:
+        r["params"] = {
+            "pictures": args.pictures,
+            "card_bytes": card_bytes,
+            "jobs": args.jobs,
+            "copy_jobs": args.copy_jobs,
+            "copy_backend": args.copy_backend,
+            "hash": args.hash,
+            "journal": args.journal,
+            "clone": args.clone,
+            "max_read_mbps": args.max_read_mbps,
+            "max_write_mbps": args.max_write_mbps,
+            "idle_io": args.idle_io,
+            "drop_cache": args.drop_cache,
+            "collisions": args.collisions,
+        }
+        r["copied"] = metrics.copied
+        r["cloned"] = metrics.cloned
+        r["throttle_wait"] = metrics.throttle_wait
+        r["failed"] = len(metrics.failed)
+        r["alt_folders"] = len(metrics.alt_folders)
+    return results
+
+
+def bench_order(folder, args):
+    """
+    Copies the same card with each --copy-order, into a new destination.
+    :returns: list of result dictionaries, one per order
+    """
+    card = os.path.join(folder, "card")
+    files = synthcard.make_card(card, pictures=args.pictures, per_folder=args.per_folder,
+        jpeg_bytes=args.jpeg_kb * 1024, nef_bytes=args.nef_kb * 1024, raw=not args.no_raw,
+        days=args.days, shuffle=True)
+    card_bytes = sum(os.path.getsize(f) for f in files)
+    os.sync() # so the files have their places on the disk
+
+    results = []
+    for order in reversed(importpics.COPY_ORDERS): # the plan order first, as the baseline
+        dest = os.path.join(folder, "dest-" + order)
+        os.makedirs(dest)
+        metrics = importpics.Metrics()
+        copyplan = importpics.CopyPlan(lookback_days=args.days + 1)
+        copyplan.destpath = dest
+        copyplan.copy_backend = args.copy_backend
+        copyplan.copy_order = order
+        with importpics.CopyLog.load(os.path.join(folder, "logs-" + order)) as copylog:
+            importpics.schedule_all(metrics, copyplan, copylog, importpics.walk_groups(card), args.jobs)
+            drop_card_cache(files)
+            start = time.perf_counter()
+            if order == "physical":
+                copyplan.groups_to_copy = importpics.physical_order(copyplan.groups_to_copy)
+            importpics.copy_all(metrics, copyplan, copylog, args.copy_jobs)
+            seconds = time.perf_counter() - start
+        results.append({
+            "benchmark": "order",
+            "order": order,
+            "seconds": seconds,
+            "files": metrics.copied,
+            "bytes": copyplan.bytes_to_copy,
+            "mb_per_sec": copyplan.bytes_to_copy / MB / seconds if seconds else None,
+            "params": {
+                "pictures": args.pictures,
+                "card_bytes": card_bytes,
+                "copy_jobs": args.copy_jobs,
+                "copy_backend": args.copy_backend,
+            },
+        })
+        shutil.rmtree(dest, ignore_errors=True)
+    return results
+
+
+def peak_rss():
+    """
+    :returns: peak resident set size of this process so far, in bytes
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def bench_memory(args):
+    """
+    Plans a synthetic archive:  JPG+NEF pairs, in DCF folders of
+    --per-folder pictures, on cards of 9000 pictures, all copied (--force).
+    Nothing is read from disk:  the EXIF results and file sizes are made up.
+    :returns: list with one result dictionary
+    """
+    before = peak_rss()
+    start = time.perf_counter()
+    exts = [".JPG"] if args.no_raw else [".JPG", ".NEF"]
+    sizes = [args.jpeg_kb * 1024, args.nef_kb * 1024]
+    end = datetime.datetime(2020, 1, 1)
+
+    copyplan = importpics.CopyPlan(lookback_days=36500, force=True)
+    copyplan.destpath = tempfile.mkdtemp(prefix="importpics-bench-")
+    index = importpics.DestIndex(copyplan.destpath)
+    metrics = importpics.Metrics()
+    try:
+        for i in range(args.files // len(exts)):
+            folder = "/media/archive/card{:04d}/DCIM/{}NIKON".format(i // 9000, 100 + i % 9000 // args.per_folder)
+            taken = end - datetime.timedelta(minutes=i)
+            fg = importpics.FileGroup()
+            for ext, size in zip(exts, sizes):
+                path = "{}/DSC_{:04d}{}".format(folder, i % 9999 + 1, ext)
+                fg.append(path, importpics.FileStat(size, int(taken.timestamp() * 1e9), 1))
+            info = concurrent.futures.Future()
+            info.set_result(("{}_nikbcc8b4".format(taken.strftime(importpics.YYMMDD)), taken, sum(sizes[:len(exts)])))
+            importpics.schedule_copy(metrics, copyplan, None, fg, info, index=index)
+    finally:
+        shutil.rmtree(copyplan.destpath, ignore_errors=True)
+    seconds = time.perf_counter() - start
+    peak = peak_rss()
+    return [{
+        "benchmark": "memory",
+        "files": copyplan.files_to_copy,
+        "groups": len(copyplan.groups_to_copy),
+        "seconds": seconds,
+        "peak_rss_mb": peak / MB,
+        "bytes_per_file": (peak - before) / copyplan.files_to_copy if copyplan.files_to_copy else None,
+    }]
+
+
+def print_results(results):
+    for r in results:
+        if r["benchmark"] == "copy":
+            print("{backend:>10} {file_mb:>6}MB x {files:<4} {seconds:8.3f}s {mb_per_sec:9.1f} MB/s".format(**r))
+        elif r["benchmark"] == "order":
+            print("{order:>10} order {seconds:8.3f}s {files:>8} files {mb_per_sec:9.1f} MB/s".format(**r))
+        elif r["benchmark"] == "memory":
+            print("{files} files in {groups} groups {seconds:8.3f}s  peak RSS {peak_rss_mb:.1f}MB, {bytes_per_file:.0f} bytes/file".format(**r))
+        else:
+            line = "{phase:>14} {seconds:8.3f}s {files:>8} files {files_per_sec:10.1f} files/s".format(**r)
+            if r["mb_per_sec"]:
+                line += " {:9.1f} MB/s".format(r["mb_per_sec"])
+            print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=["copy", "e2e", "order", "memory"], help="which benchmark to run")
+    parser.add_argument("--dir", default=None, help="folder to create test files in (default: a temp folder)")
+    parser.add_argument("--json", default=None, help="also write the results to this file as JSON")
+    parser.add_argument("--size-mb", type=int, nargs="+", default=[50, 500], help="file sizes to copy, in MB")
+    parser.add_argument("--count", type=int, default=5, help="number of files of each size")
+    parser.add_argument("--backend", nargs="+", default=sorted(fastcopy.BACKENDS.keys()), help="copy backends to compare")
+    parser.add_argument("--fsync", action="store_true", default=False, help="include an fsync of each copy in the time")
+    e2e = parser.add_argument_group("e2e (order also uses --pictures, --per-folder, --jpeg-kb, --nef-kb, --no-raw, --days, --jobs, --copy-jobs and --copy-backend)")
+    e2e.add_argument("--pictures", type=int, default=1000, help="number of pictures on the card")
+    e2e.add_argument("--per-folder", type=int, default=500, help="pictures per DCF folder")
+    e2e.add_argument("--jpeg-kb", type=int, default=200, help="size of each JPG")
+    e2e.add_argument("--nef-kb", type=int, default=1024, help="size of each NEF")
+    e2e.add_argument("--no-raw", action="store_true", default=False, help="only JPGs, no NEFs")
+    e2e.add_argument("--days", type=int, default=5, help="days the pictures are spread over")
+    e2e.add_argument("--cameras", type=int, default=1, help="number of camera serial numbers")
+    e2e.add_argument("--collisions", type=int, default=10, help="files to pre-create in the destination with the wrong size")
+    e2e.add_argument("--jobs", type=int, default=4, help="importpics --jobs")
+    e2e.add_argument("--copy-jobs", type=int, default=1, help="importpics --copy-jobs")
+    e2e.add_argument("--copy-backend", choices=sorted(fastcopy.BACKENDS.keys()), default=fastcopy.DEFAULT_BACKEND, help="importpics --copy-backend")
+    e2e.add_argument("--hash", choices=fastcopy.HASH_ALGORITHMS, default=None, help="importpics --hash")
+    e2e.add_argument("--journal", action="store_true", default=False, help="importpics --journal")
+    e2e.add_argument("--clone", nargs="?", const="reflink", default=None, choices=fastcopy.CLONE_MODES, help="importpics --clone (the card is on the same filesystem as the destination)")
+    e2e.add_argument("--max-read-mbps", type=float, default=None, help="importpics --max-read-mbps")
+    e2e.add_argument("--max-write-mbps", type=float, default=None, help="importpics --max-write-mbps")
+    e2e.add_argument("--idle-io", action="store_true", default=False, help="importpics --idle-io")
+    e2e.add_argument("--drop-cache", action="store_true", default=False, help="importpics --drop-cache")
+    memory = parser.add_argument_group("memory (also uses --per-folder, --jpeg-kb, --nef-kb and --no-raw)")
+    memory.add_argument("--files", type=int, default=1000000, help="number of files in the archive")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    folder = tempfile.mkdtemp(prefix="importpics-bench-", dir=args.dir)
+    try:
+        if args.benchmark == "copy":
+            results = bench_copy(folder, args.size_mb, args.count, args.backend, args.fsync)
+        elif args.benchmark == "e2e":
+            results = bench_e2e(folder, args)
+        elif args.benchmark == "order":
+            results = bench_order(folder, args)
+        elif args.benchmark == "memory":
+            results = bench_memory(args)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    print_results(results)
+    if args.json:
+        report = {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "results": results,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -5,11 +5,15 @@ Utility methods for dealing with disks
 TODO: the unit tests for this class create temp files
 AND dont even bother to clean them up.
 """
+import collections
 import inspect
 import math
 import os
+import re
+import select
 import shlex
 import subprocess
+import sys
 from subprocess import PIPE
 
 def to_lines(stdout):
@@ -96,8 +100,8 @@ def avail_space(path):
     return stats.f_frsize * stats.f_bavail
 
 
-def get_volume_list():
-    """:returns: list of removable media"""
+def find_flash_macos():
+    """:returns: mount points of removable media, from findflash.macos.sh"""
     mypath = os.path.dirname(os.path.abspath(inspect.stack()[0][1]))
     cmdpath = os.path.join(mypath, "findflash.macos.sh")
     cmd = shlex.split(cmdpath)
@@ -110,7 +114,220 @@ def get_volume_list():
         return to_lines(stdout)
 
 
-def alt_folder(simplename, digits=2, start=1):
+MOUNTINFO = "/proc/self/mountinfo"
+
+Mount = collections.namedtuple("Mount", ["mount_id", "device", "root", "mountpoint", "fstype", "source"])
+
+
+def unescape_mount(field):
+    r"""
+    mountinfo escapes spaces, tabs, newlines and backslashes as octal
+
+    >>> unescape_mount(r"/media/NIKON\040D750")
+    '/media/NIKON D750'
+    """
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+
+def parse_mountinfo(text):
+    r"""
+    Parses the contents of /proc/<pid>/mountinfo (see proc(5))
+
+    >>> line = r"36 35 8:17 / /media/NIKON\040D750 rw,nosuid shared:1 - vfat /dev/sdb1 rw,fmask=0022"
+    >>> parse_mountinfo(line + "\n")
+    [Mount(mount_id=36, device='8:17', root='/', mountpoint='/media/NIKON D750', fstype='vfat', source='/dev/sdb1')]
+    """
+    mounts = []
+    for line in to_lines(text):
+        fields = line.split(" ")
+        sep = fields.index("-", 6) # optional fields come before the separator
+        mounts.append(Mount(
+            int(fields[0]),
+            fields[2],
+            unescape_mount(fields[3]),
+            unescape_mount(fields[4]),
+            fields[sep + 1],
+            unescape_mount(fields[sep + 2]),
+        ))
+    return mounts
+
+
+SYSFS = "/sys"
+
+Volume = collections.namedtuple("Volume", ["path", "fstype", "source", "avail", "size"])
+
+
+def volume_info(path, fstype = None, source = None):
+    stats = os.statvfs(path)
+    return Volume(path, fstype, source, stats.f_frsize * stats.f_bavail, stats.f_frsize * stats.f_blocks)
+
+
+def is_removable(device, sysfs = SYSFS):
+    """
+    True if the block device is removable media, like a card in a USB card
+    reader, or a card in a built in SD slot (those often don't say they are
+    removable).
+    :param device: "major:minor" of the device, e.g. from mountinfo
+    """
+    path = os.path.join(sysfs, "dev", "block", device)
+    if not os.path.exists(path):
+        return False # not a block device, e.g. tmpfs or nfs
+    path = os.path.realpath(path)
+    if os.path.exists(os.path.join(path, "partition")):
+        path = os.path.dirname(path) # only whole disks have "removable"
+    try:
+        with open(os.path.join(path, "removable"), 'r') as f:
+            if f.read().strip() == "1":
+                return True
+    except OSError:
+        return False
+    return os.path.basename(path).startswith("mmcblk")
+
+
+class MountWatcher:
+    """
+    Waits for filesystems to be mounted or unmounted.  The kernel flags
+    mountinfo with POLLPRI when the mount table changes, so waiting costs
+    nothing; it is also re-read every `timeout` seconds in case that isn't
+    supported.
+    """
+    def __init__(self, path = MOUNTINFO):
+        self.path = path
+        self.fh = open(path, 'r')
+        self.poller = select.poll()
+        self.poller.register(self.fh.fileno(), select.POLLPRI | select.POLLERR)
+
+    def mounts(self):
+        self.fh.seek(0)
+        return parse_mountinfo(self.fh.read())
+
+    def wait(self, timeout):
+        """
+        :returns: True if the kernel said the mounts changed, False if the
+            timeout expired (they may still have changed)
+        """
+        return bool(self.poller.poll(timeout * 1000))
+
+    def close(self):
+        self.fh.close()
+
+
+class VolumeFinder:
+    r"""
+    Finds mounted removable media on Linux without running anything:  the
+    mounts come from mountinfo, and whether they are removable from sysfs.
+    The list (with free space) is kept until mountinfo says the mounts
+    changed.
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> card, disk = os.path.join(root, "card"), os.path.join(root, "disk")
+    >>> for dev, part, removable in [("8:17", "sdb/sdb1", "1"), ("8:1", "sda/sda1", "0")]:
+    ...     os.makedirs(os.path.join(root, "sys/devices/block", part))
+    ...     _ = open(os.path.join(root, "sys/devices/block", part, "partition"), "w").write("1")
+    ...     _ = open(os.path.join(root, "sys/devices/block", os.path.dirname(part), "removable"), "w").write(removable)
+    ...     os.makedirs(os.path.join(root, "sys/dev/block"), exist_ok=True)
+    ...     os.symlink(os.path.join(root, "sys/devices/block", part), os.path.join(root, "sys/dev/block", dev))
+    >>> os.makedirs(card)
+    >>> mountinfo = os.path.join(root, "mountinfo")
+    >>> with open(mountinfo, "w") as f:
+    ...     _ = f.write("20 1 8:1 / / rw - ext4 /dev/sda1 rw\n")
+    ...     _ = f.write("21 20 0:5 / /proc rw - proc proc rw\n")
+    ...     _ = f.write("36 20 8:17 / {} rw - vfat /dev/sdb1 rw\n".format(card))
+    >>> volumes = VolumeFinder(mountinfo, os.path.join(root, "sys")).volumes()
+    >>> [(v.path == card, v.fstype, v.source, v.avail > 0) for v in volumes]
+    [(True, 'vfat', '/dev/sdb1', True)]
+    """
+    def __init__(self, mountinfo = MOUNTINFO, sysfs = SYSFS):
+        self.watcher = MountWatcher(mountinfo)
+        self.sysfs = sysfs
+        self.cached = None
+
+    def volumes(self):
+        """:returns: list of Volumes"""
+        if self.cached is None or self.watcher.wait(0):
+            self.cached = self.scan()
+        return self.cached
+
+    def scan(self):
+        volumes = []
+        seen = set()
+        for m in self.watcher.mounts():
+            if m.mountpoint in seen or not is_removable(m.device, self.sysfs):
+                continue
+            seen.add(m.mountpoint)
+            try:
+                volumes.append(volume_info(m.mountpoint, m.fstype, m.source))
+            except OSError:
+                pass # unmounted since, or not readable
+        return volumes
+
+
+DISK_IDS = "/dev/disk"
+
+def volume_id(path, mountinfo = MOUNTINFO, disks = DISK_IDS):
+    r"""
+    Identifies the filesystem a path is on by its UUID, or by its label if
+    it has no UUID, from the links udev makes in /dev/disk/by-uuid and
+    /dev/disk/by-label.
+    :returns: "uuid:<UUID>" or "label:<label>", or None if neither is known
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> card = os.path.join(root, "media", "NIKON D750")
+    >>> os.makedirs(card)
+    >>> os.makedirs(os.path.join(root, "disk", "by-uuid"))
+    >>> open(os.path.join(root, "sdb1"), "w").close()
+    >>> os.symlink(os.path.join(root, "sdb1"), os.path.join(root, "disk", "by-uuid", "1234-ABCD"))
+    >>> mountinfo = os.path.join(root, "mountinfo")
+    >>> with open(mountinfo, "w") as f:
+    ...     _ = f.write("1 0 8:1 / / rw - ext4 /dev/sda1 rw\n")
+    ...     _ = f.write("36 1 8:17 / {} rw - vfat {} rw\n".format(card.replace(" ", "\\040"), os.path.join(root, "sdb1")))
+    >>> volume_id(os.path.join(card, "DCIM"), mountinfo, os.path.join(root, "disk"))
+    'uuid:1234-ABCD'
+    >>> volume_id(root, mountinfo, os.path.join(root, "disk")) is None
+    True
+    """
+    try:
+        with open(mountinfo, 'r') as f:
+            mounts = parse_mountinfo(f.read())
+    except OSError:
+        return None
+    path = os.path.realpath(path)
+    mount = None
+    for m in mounts:
+        if path == m.mountpoint or path.startswith(m.mountpoint.rstrip("/") + "/"):
+            # the deepest one, and the last one mounted there
+            if mount is None or len(m.mountpoint) >= len(mount.mountpoint):
+                mount = m
+    if mount is None or not os.path.isabs(mount.source):
+        return None
+    device = os.path.realpath(mount.source)
+    for kind in ["uuid", "label"]:
+        folder = os.path.join(disks, "by-" + kind)
+        try:
+            names = sorted(os.listdir(folder))
+        except OSError:
+            continue
+        for name in names:
+            if os.path.realpath(os.path.join(folder, name)) == device:
+                return "{}:{}".format(kind, name)
+    return None
+
+
+_finder = None
+
+def get_volume_list():
+    """:returns: list of Volumes of removable media"""
+    global _finder
+    if os.path.exists(MOUNTINFO):
+        if _finder is None:
+            _finder = VolumeFinder()
+        return _finder.volumes()
+    return [volume_info(path) for path in find_flash_macos()]
+
+
+def alt_folder(simplename, digits=2, start=1, exists=os.path.isdir):
     """
     Find an alternate folder by incrementing a digit
 
@@ -149,6 +366,10 @@ def alt_folder(simplename, digits=2, start=1):
     Traceback (most recent call last):
         ...
     Exception: ...
+    >>> alt_folder("dtest", exists=lambda name: name in ["dtest_01", "dtest_02"])
+    'dtest_03'
+
+    :param exists: function that says if a folder already exists
     """
     if not simplename:
         raise ValueError()
@@ -158,7 +379,7 @@ def alt_folder(simplename, digits=2, start=1):
     stop = int(math.pow(10, digits))
     for alt in range(start, stop):
         altfolder = "{}_{}".format(simplename, str(alt).zfill(digits))
-        if not os.path.isdir(altfolder):
+        if not exists(altfolder):
             return altfolder
     raise Exception("cannot find alternate folder for {}".format(simplename))
 
@@ -0,0 +1,614 @@
+"""
+Ways of copying a single picture file, selected with --copy-backend.
+
+    copy      shutil.copy(), copies the data and the permission bits (the
+              original behavior)
+    copyfile  shutil.copyfile(), only copies the data
+    kernel    copies the data inside the kernel with os.copy_file_range() (or
+              os.sendfile()) in large chunks, so it never passes through a
+              userspace buffer.  Falls back to a plain read/write loop if
+              neither works between the two filesystems.
+
+With --hash the backend is not used:  the file is copied with a read/write
+loop that feeds every buffer to the hash as well, so the source is still only
+read once.  Digests are written as
+"<algorithm>:<hex digest>".  xxhash algorithms are available if the xxhash
+package is installed.
+
+When a file goes to several destinations (--also-copy-to), copy_fanout()
+reads it once and writes every buffer to all of them.
+
+On a machine that has other work to do, a Throttle limits how fast the
+copies read and write (--max-read-mbps, --max-write-mbps), can lower the
+I/O priority of the threads copying to idle (--idle-io), and can keep the
+copies out of the page cache (--drop-cache).  Throttled copies always use a
+read/write loop, so that every buffer can be accounted for.
+
+Sources are read with POSIX_FADV_SEQUENTIAL, and prefetch() can start
+reading the next file into the page cache while the current one is being
+written.  first_extent() tells where a file's data starts on the disk, so
+files can be read in the order they are laid out (see
+importpics.physical_order()).
+
+When the source and the destination are on the same filesystem, clone()
+can make the copy without writing the data again (--clone):
+
+    reflink   the copy shares the data blocks of the source until either
+              one is changed (FICLONE, on btrfs, XFS and other filesystems
+              that support it)
+    hardlink  the copy is another name for the same file, so changing one
+              changes both
+"""
+import ctypes
+import errno
+import hashlib
+import mmap
+import os
+import platform
+import shutil
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+CHUNK_SIZE = 64 * 1024 * 1024 # bytes per copy_file_range/sendfile call
+BUFFER_SIZE = 1024 * 1024 # buffer for the read/write fallback
+
+# errors that mean "this syscall can't copy between these two files"
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF, errno.EPERM)
+
+
+def _copy_file_range(infd, outfd):
+    copied = 0
+    while True:
+        n = os.copy_file_range(infd, outfd, CHUNK_SIZE)
+        if n == 0:
+            return copied
+        copied += n
+
+
+def _sendfile(infd, outfd):
+    copied = 0
+    while True:
+        n = os.sendfile(outfd, infd, None, CHUNK_SIZE)
+        if n == 0:
+            return copied
+        copied += n
+
+
+def kernel_copyfd(infd, outfd):
+    """
+    Copies everything from the current position of infd to outfd, trying
+    copy_file_range(), then sendfile(), then a read/write loop.
+    :returns: name of the method that was used
+    """
+    for name, method in (("copy_file_range", _copy_file_range), ("sendfile", _sendfile)):
+        if not hasattr(os, name):
+            continue
+        try:
+            method(infd, outfd)
+            return name
+        except OSError as ex:
+            # only safe to fall back if nothing was written yet
+            if ex.errno not in _UNSUPPORTED or os.lseek(outfd, 0, os.SEEK_CUR) != 0:
+                raise
+    with os.fdopen(os.dup(infd), 'rb') as fsrc, os.fdopen(os.dup(outfd), 'wb') as fdst:
+        shutil.copyfileobj(fsrc, fdst, BUFFER_SIZE)
+    return "read/write"
+
+
+def copy_kernel(src, dst):
+    """
+    Copies the data of src to dst without passing it through userspace if the
+    kernel allows it.  Permission bits are not copied.
+
+    >>> import tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> src, dst = os.path.join(folder, "a"), os.path.join(folder, "b")
+    >>> with open(src, "wb") as f:
+    ...     _ = f.write(b"x" * 100000)
+    >>> copy_kernel(src, dst)
+    >>> open(dst, "rb").read() == open(src, "rb").read()
+    True
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        advise_sequential(fsrc.fileno())
+        kernel_copyfd(fsrc.fileno(), fdst.fileno())
+
+
+def new_hash(algorithm):
+    if algorithm.startswith("xxh"):
+        if xxhash is None:
+            raise ValueError("{} needs the xxhash package".format(algorithm))
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+HASH_ALGORITHMS = ["blake2b", "sha256"]
+if xxhash is not None:
+    HASH_ALGORITHMS += ["xxh3_128", "xxh64"]
+
+DEFAULT_HASH = "blake2b"
+
+
+class TokenBucket:
+    """
+    Limits a rate, in bytes per second.  take() waits until the bytes may be
+    used, letting through bursts of up to `burst` bytes after a pause.
+    Several threads share the same rate.
+
+    >>> bucket = TokenBucket(10 * 1024 * 1024, burst=1024 * 1024)
+    >>> bucket.take(1024 * 1024)
+    0.0
+    >>> 0.05 < bucket.take(1024 * 1024) < 0.15
+    True
+    """
+    def __init__(self, rate, burst = None):
+        if rate <= 0:
+            raise ValueError()
+        self.rate = float(rate)
+        self.burst = float(burst or max(BUFFER_SIZE, rate / 4))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, nbytes):
+        """
+        :returns: seconds waited
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # the bytes are reserved right away, so the threads waiting are
+            # let through in the order they came
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_SET = { "x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314 } # syscall numbers
+
+
+def set_io_idle():
+    """
+    Puts the calling thread in the idle I/O scheduling class (like
+    `ionice -c 3`), so its reads and writes only get the disk when nothing
+    else wants it.  Only Linux has it, and only the BFQ and CFQ schedulers
+    use it.
+    :returns: True if it worked
+    """
+    nr = IOPRIO_SET.get(platform.machine())
+    if nr is None or platform.system() != "Linux":
+        return False
+    libc = ctypes.CDLL(None, use_errno=True)
+    # with IOPRIO_WHO_PROCESS, 0 is the calling thread
+    return libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) == 0
+
+
+def advise_sequential(fd):
+    """
+    Tells the kernel the file will be read from start to end, so it reads
+    further ahead
+    """
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+
+def prefetch(path, length = 0):
+    """
+    Starts reading the start of a file (or all of it) into the page cache in
+    the background, so it is there when it is copied.  Errors are ignored.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, length, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+FS_IOC_FIEMAP = 0xC020660B # _IOWR('f', 11, struct fiemap) from linux/fs.h
+FIEMAP_EXTENT_UNKNOWN = 0x2
+FIEMAP_EXTENT_DELALLOC = 0x4
+FIEMAP = "=QQIII4x" # fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count
+FIEMAP_EXTENT = "=QQQ16xI12x" # fe_logical, fe_physical, fe_length, fe_flags
+
+
+def first_extent(path):
+    """
+    Asks the filesystem (with the FIEMAP ioctl) where the data of a file
+    starts on the disk.
+    :returns: the offset in bytes, or None if it can't tell (other platforms,
+        filesystems without FIEMAP, empty files)
+    """
+    if fcntl is None:
+        return None
+    request = struct.pack(FIEMAP, 0, 2 ** 64 - 1, 0, 0, 1) + bytes(struct.calcsize(FIEMAP_EXTENT))
+    buf = bytearray(request)
+    try:
+        with open(path, 'rb') as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, buf)
+    except OSError:
+        return None
+    mapped = struct.unpack_from(FIEMAP, buf)[3]
+    if not mapped:
+        return None
+    logical, physical, length, flags = struct.unpack_from(FIEMAP_EXTENT, buf, struct.calcsize(FIEMAP))
+    if flags & (FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_DELALLOC):
+        return None # not written to the disk yet
+    return physical
+
+
+def drop_cache(fd, offset = 0, length = 0):
+    """
+    Tells the kernel the data won't be needed again, so it leaves the page
+    cache to other programs.  Pages still being written are not dropped.
+    """
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+
+class Throttle:
+    """
+    How copies share the machine with other work:  limits on the read and
+    write rates (in MB/s, shared by every thread copying with this
+    Throttle), the idle I/O class for the threads, and dropping the copied
+    data from the page cache.  It is passed to copy() and friends.
+    """
+    def __init__(self, read_mbps = None, write_mbps = None, idle = False, nocache = False):
+        self.read_mbps = read_mbps
+        self.write_mbps = write_mbps
+        self.reads = TokenBucket(read_mbps * 1024 * 1024) if read_mbps else None
+        self.writes = TokenBucket(write_mbps * 1024 * 1024) if write_mbps else None
+        self.idle = idle
+        self.nocache = nocache
+        self.local = threading.local()
+
+    def enter(self):
+        """
+        Sets up the calling thread, the first time it copies
+        """
+        if getattr(self.local, "entered", False):
+            return
+        self.local.entered = True
+        self.local.waited = 0.0
+        if self.idle and not set_io_idle():
+            self.idle = False # don't try again on every thread
+
+    def read(self, nbytes):
+        if self.reads is not None:
+            self.local.waited += self.reads.take(nbytes)
+
+    def write(self, nbytes):
+        if self.writes is not None:
+            self.local.waited += self.writes.take(nbytes)
+
+    def waited(self):
+        """
+        :returns: seconds the calling thread has waited for the limits so far
+        """
+        return getattr(self.local, "waited", 0.0)
+
+
+def copy_throttled(src, dst, throttle, hash_algorithm = None):
+    """
+    Copies the data of src to dst with a read/write loop that keeps to the
+    limits of the Throttle, hashing it on the way through if hash_algorithm
+    is given.  With throttle.nocache the source is dropped from the page
+    cache as it is read, and the copy once it is written (which means
+    waiting for it to be on the disk).
+    :returns: digest of the data, or None if it wasn't hashed
+
+    >>> import tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> src, dst = os.path.join(folder, "a"), os.path.join(folder, "b")
+    >>> with open(src, "wb") as f:
+    ...     _ = f.write(b"abc")
+    >>> copy_throttled(src, dst, Throttle(read_mbps=100, nocache=True), "sha256") == copy_hashed(src, dst, "sha256")
+    True
+    """
+    digest, errors = copy_fanout(src, [dst], hash_algorithm, throttle=throttle)
+    if errors:
+        raise errors[dst]
+    return digest
+
+
+def copy_hashed(src, dst, algorithm = DEFAULT_HASH):
+    """
+    Copies the data of src to dst, hashing it on the way through.
+    :returns: digest of the data, as "<algorithm>:<hex digest>"
+
+    >>> import tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> src, dst = os.path.join(folder, "a"), os.path.join(folder, "b")
+    >>> with open(src, "wb") as f:
+    ...     _ = f.write(b"abc")
+    >>> copy_hashed(src, dst, "sha256")
+    'sha256:ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad'
+    >>> file_digest(dst, "sha256") == copy_hashed(src, dst, "sha256")
+    True
+    """
+    h = new_hash(algorithm)
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(src, 'rb', buffering=0) as fsrc, open(dst, 'wb', buffering=0) as fdst:
+        advise_sequential(fsrc.fileno())
+        while True:
+            n = fsrc.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+            written = 0
+            while written < n:
+                written += fdst.write(view[written:n])
+    return "{}:{}".format(algorithm, h.hexdigest())
+
+
+def file_digest(path, algorithm = DEFAULT_HASH, uncached = False, throttle = None):
+    """
+    Hashes a file.
+    :param uncached: drop the file from the page cache first, so the data is
+        read back from the disk rather than from memory
+    :param throttle: optional Throttle for the reads
+    :returns: digest of the data, as "<algorithm>:<hex digest>"
+    """
+    h = new_hash(algorithm)
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+    if throttle is not None:
+        throttle.enter()
+    with open(path, 'rb', buffering=0) as f:
+        if uncached:
+            os.fsync(f.fileno())
+            drop_cache(f.fileno())
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            if throttle is not None:
+                throttle.read(n)
+            h.update(view[:n])
+        if throttle is not None and throttle.nocache:
+            drop_cache(f.fileno())
+    return "{}:{}".format(algorithm, h.hexdigest())
+
+
+PARTIAL_SIZE = 64 * 1024 # bytes hashed from each end of a file by partial_digest()
+
+
+def partial_digest(path):
+    """
+    Hashes the size and the first and last PARTIAL_SIZE bytes of a file,
+    which is enough to tell pictures of the same size apart (the EXIF data is
+    at the start) without reading all of them.
+    :returns: digest, as "<algorithm>:<hex digest>"
+
+    >>> import tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> a, b = os.path.join(folder, "a"), os.path.join(folder, "b")
+    >>> for path, middle in [(a, b"x"), (b, b"y")]:
+    ...     with open(path, "wb") as f:
+    ...         _ = f.write(b"0" * PARTIAL_SIZE + middle + b"0" * PARTIAL_SIZE)
+    >>> partial_digest(a) == partial_digest(b), file_digest(a) == file_digest(b)
+    (True, False)
+    """
+    h = new_hash(DEFAULT_HASH)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        h.update(str(size).encode("ascii"))
+        h.update(f.read(PARTIAL_SIZE))
+        if size > PARTIAL_SIZE:
+            f.seek(max(PARTIAL_SIZE, size - PARTIAL_SIZE))
+            h.update(f.read(PARTIAL_SIZE))
+    return "{}:{}".format(DEFAULT_HASH, h.hexdigest())
+
+
+def mmap_digest(path, algorithm = DEFAULT_HASH):
+    """
+    Hashes a file by mapping it into memory, so the data is hashed straight
+    from the page cache without being copied into a buffer first.  The hash
+    functions release the GIL while they work on it, so several files can be
+    hashed on different cores from a pool of threads.
+    :returns: digest of the data, as "<algorithm>:<hex digest>"
+
+    >>> import tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> path = os.path.join(folder, "a")
+    >>> with open(path, "wb") as f:
+    ...     _ = f.write(b"abc" * 100000)
+    >>> mmap_digest(path) == file_digest(path)
+    True
+    >>> open(path, "wb").close()
+    >>> mmap_digest(path, "sha256")
+    'sha256:e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+    """
+    h = new_hash(algorithm)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > 0: # empty files can't be mapped
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                h.update(m)
+    return "{}:{}".format(algorithm, h.hexdigest())
+
+
+def copy_fanout(src, dsts, hash_algorithm = None, copy_mode = False, throttle = None):
+    """
+    Copies the data of src to several files, reading it only once.  The
+    writes go to the page cache, so the disks write them back at the same
+    time.  A destination that fails is dropped, and the others are finished.
+    :param copy_mode: also copy the permission bits, like shutil.copy()
+    :param throttle: optional Throttle, see copy_throttled()
+    :returns: tuple of (digest of the data, or None if hash_algorithm isn't
+        given, dictionary of (destination -> OSError) for the ones that failed)
+
+    >>> import tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> src = os.path.join(folder, "a")
+    >>> with open(src, "wb") as f:
+    ...     _ = f.write(b"abc")
+    >>> dsts = [os.path.join(folder, "b"), os.path.join(folder, "missing", "c"), os.path.join(folder, "d")]
+    >>> digest, errors = copy_fanout(src, dsts, "sha256")
+    >>> digest == copy_hashed(src, dsts[0], "sha256"), list(errors) == [dsts[1]], open(dsts[2], "rb").read()
+    (True, True, b'abc')
+    """
+    h = new_hash(hash_algorithm) if hash_algorithm else None
+    errors = {}
+    outs = {}
+    if throttle is not None:
+        throttle.enter()
+    for dst in dsts:
+        try:
+            outs[dst] = open(dst, 'wb', buffering=0)
+        except OSError as ex:
+            errors[dst] = ex
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+    try:
+        with open(src, 'rb', buffering=0) as fsrc:
+            advise_sequential(fsrc.fileno())
+            offset = 0
+            while outs:
+                n = fsrc.readinto(buf)
+                if not n:
+                    break
+                if throttle is not None:
+                    throttle.read(n)
+                    if throttle.nocache:
+                        drop_cache(fsrc.fileno(), offset, n)
+                    throttle.write(n * len(outs))
+                offset += n
+                if h is not None:
+                    h.update(view[:n])
+                for dst, fdst in list(outs.items()):
+                    try:
+                        written = 0
+                        while written < n:
+                            written += fdst.write(view[written:n])
+                    except OSError as ex:
+                        errors[dst] = ex
+                        fdst.close()
+                        del outs[dst]
+        if throttle is not None and throttle.nocache:
+            for dst, fdst in list(outs.items()):
+                try:
+                    os.fdatasync(fdst.fileno()) # dirty pages can't be dropped
+                    drop_cache(fdst.fileno())
+                except OSError as ex:
+                    errors[dst] = ex
+                    fdst.close()
+                    del outs[dst]
+    finally:
+        for fdst in outs.values():
+            fdst.close()
+    if copy_mode:
+        for dst in outs:
+            try:
+                shutil.copymode(src, dst)
+            except OSError as ex:
+                errors[dst] = ex
+    digest = "{}:{}".format(hash_algorithm, h.hexdigest()) if h is not None else None
+    return digest, errors
+
+
+FICLONE = 0x40049409 # _IOW(0x94, 9, int) from linux/fs.h
+
+CLONE_MODES = ["reflink", "hardlink"]
+
+
+def reflink(src, dst):
+    """
+    Makes dst a copy of src that shares its data blocks, without copying
+    them.  Raises OSError if the filesystem can't (dst is not left behind).
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this platform", dst)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            os.remove(dst)
+            raise
+
+
+def clone(src, dst, mode = "reflink"):
+    """
+    Copies src to dst without copying the data, see CLONE_MODES.  Raises
+    OSError if it can't, e.g. when they are on different filesystems.
+
+    >>> import tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> src, dst = os.path.join(folder, "a"), os.path.join(folder, "b")
+    >>> with open(src, "wb") as f:
+    ...     _ = f.write(b"abc")
+    >>> clone(src, dst, "hardlink")
+    >>> os.path.samefile(src, dst)
+    True
+    """
+    if mode == "hardlink":
+        os.link(src, dst)
+    elif mode == "reflink":
+        reflink(src, dst)
+    else:
+        raise ValueError(mode)
+
+
+BACKENDS = {
+    "copy": shutil.copy,
+    "copyfile": shutil.copyfile,
+    "kernel": copy_kernel,
+}
+
+DEFAULT_BACKEND = "copy"
+
+
+def copy(src, dst, backend = DEFAULT_BACKEND, hash_algorithm = None, throttle = None):
+    """
+    Copies one file using the named backend, or hashes it while copying if
+    hash_algorithm is given.
+    :param throttle: optional Throttle;  the backend is not used then, but
+        the permission bits are still copied for "copy"
+    :returns: digest of the data, or None if it wasn't hashed
+
+    >>> import stat, tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> src, dst = os.path.join(folder, "a"), os.path.join(folder, "b")
+    >>> with open(src, "wb") as f:
+    ...     _ = f.write(b"abc")
+    >>> os.chmod(src, 0o640)
+    >>> copy(src, dst, hash_algorithm="sha256")[:7], oct(stat.S_IMODE(os.stat(dst).st_mode))
+    ('sha256:', '0o640')
+    """
+    if throttle is not None:
+        digest = copy_throttled(src, dst, throttle, hash_algorithm)
+        if backend == "copy":
+            shutil.copymode(src, dst)
+        return digest
+    if hash_algorithm:
+        digest = copy_hashed(src, dst, hash_algorithm)
+        if backend == "copy":
+            shutil.copymode(src, dst)
+        return digest
+    BACKENDS[backend](src, dst)
+    return None
@@ -0,0 +1,252 @@
+"""
+Reads just the handful of EXIF tags that importpics needs (camera make, model
+and serial number, and the three date tags) from the start of a JPEG, or from
+IFD0/the EXIF IFD of a TIFF based raw file like a NEF.
+
+exifread parses every tag in the file, including the MakerNote and thumbnails,
+which means a lot of extra reads when the file is on a slow card reader.  This
+only looks at the few IFD entries it needs.  The tags are returned under the
+same names, and with the same string values, that exifread would produce, so
+the camera hash of a picture does not change depending on which reader was
+used.  Anything unusual falls back to exifread.
+"""
+import logging
+import struct
+
+import exifread
+
+logger = logging.getLogger("importpics")
+
+# exifread names of the tags we return
+MAKE = "Image Make"
+MODEL = "Image Model"
+DATETIME = "Image DateTime"
+DATETIME_ORIGINAL = "EXIF DateTimeOriginal"
+DATETIME_DIGITIZED = "EXIF DateTimeDigitized"
+SERIAL = "MakerNote SerialNumber"
+
+WANTED_TAGS = [MAKE, MODEL, DATETIME, DATETIME_ORIGINAL, DATETIME_DIGITIZED, SERIAL]
+
+# IFD0
+_IFD0_TAGS = {0x010F: MAKE, 0x0110: MODEL, 0x0132: DATETIME}
+_EXIF_IFD_POINTER = 0x8769
+
+# EXIF IFD
+_EXIF_TAGS = {0x9003: DATETIME_ORIGINAL, 0x9004: DATETIME_DIGITIZED}
+_MAKERNOTE = 0x927C
+
+# field types
+_ASCII = 2
+_SHORT = 3
+_LONG = 4
+_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+
+HEAD_SIZE = 64 * 1024 # how much of the file to read up front
+
+
+class Unsupported(Exception):
+    """
+    Raised when a file has something we don't know how to read quickly.
+    """
+    pass
+
+
+class _TiffReader:
+    """
+    Reads values out of a TIFF structure that starts at `base` in the file.
+    Reads are served from `head` (the first bytes of the file) if possible.
+    """
+    def __init__(self, fh, head, base):
+        self.fh = fh
+        self.head = head
+        self.base = base
+        order = self.read(0, 4)
+        if order == b"MM\x00*":
+            self.endian = ">"
+        elif order == b"II*\x00":
+            self.endian = "<"
+        else:
+            raise Unsupported("bad TIFF header")
+
+    def read(self, offset, size):
+        pos = self.base + offset
+        if pos + size <= len(self.head):
+            return self.head[pos:pos + size]
+        self.fh.seek(pos)
+        data = self.fh.read(size)
+        if len(data) != size:
+            raise Unsupported("truncated file")
+        return data
+
+    def unpack(self, fmt, offset):
+        fmt = self.endian + fmt
+        return struct.unpack(fmt, self.read(offset, struct.calcsize(fmt)))[0]
+
+    def entries(self, ifd):
+        """
+        Yields (tag, field type, count, offset of the value) for each entry in
+        an IFD.  Offsets are relative to the TIFF header.
+        """
+        count = self.unpack("H", ifd)
+        table = self.read(ifd + 2, 12 * count)
+        for i in range(count):
+            tag, ftype, vcount = struct.unpack(self.endian + "HHI", table[12 * i:12 * i + 8])
+            if ftype not in _TYPE_SIZES:
+                raise Unsupported("unknown field type {}".format(ftype))
+            voffset = ifd + 2 + 12 * i + 8
+            if vcount * _TYPE_SIZES[ftype] > 4:
+                voffset = self.unpack("I", voffset)
+            yield tag, ftype, vcount, voffset
+
+    def value(self, ftype, count, offset):
+        """
+        Returns a value formatted the way str() of an exifread tag would.
+        """
+        if ftype == _ASCII:
+            if count == 0:
+                return ""
+            data = self.read(offset, count).split(b"\x00", 1)[0]
+            try:
+                return data.decode("utf-8")
+            except UnicodeDecodeError:
+                raise Unsupported("non utf-8 string")
+        elif ftype in (_SHORT, _LONG) and count == 1:
+            return str(self.unpack("H" if ftype == _SHORT else "I", offset))
+        raise Unsupported("unexpected field type {}".format(ftype))
+
+
+def _read_tiff(reader):
+    tags = {}
+    exif_ifd = None
+    for tag, ftype, count, offset in reader.entries(reader.unpack("I", 4)):
+        if tag in _IFD0_TAGS:
+            tags[_IFD0_TAGS[tag]] = reader.value(ftype, count, offset)
+        elif tag == _EXIF_IFD_POINTER:
+            exif_ifd = reader.unpack("I", offset)
+
+    makernote = None
+    if exif_ifd:
+        for tag, ftype, count, offset in reader.entries(exif_ifd):
+            if tag in _EXIF_TAGS:
+                tags[_EXIF_TAGS[tag]] = reader.value(ftype, count, offset)
+            elif tag == _MAKERNOTE:
+                makernote = (count, offset)
+
+    # exifread only decodes the MakerNote if it knows the Make
+    if makernote and MAKE in tags:
+        serial = _makernote_serial(reader, tags[MAKE], *makernote)
+        if serial is not None:
+            tags[SERIAL] = serial
+    return tags
+
+
+def _makernote_serial(reader, make, count, offset):
+    """
+    Finds the serial number in the MakerNote, using the same rules as
+    exifread's decode_maker_note() for the makes that have one.
+    """
+    if "NIKON" in make:
+        label = reader.read(offset, min(count, 14))
+        if label[0:7] == b"Nikon\x00\x01":
+            return None # type 1 MakerNotes don't have a serial number
+        elif label[0:7] == b"Nikon\x00\x02":
+            # a whole TIFF header is embedded in the note, and exifread
+            # reads it using the byte order of the outer file
+            if label[10:12] != (b"MM" if reader.endian == ">" else b"II"):
+                raise Unsupported("MakerNote byte order differs")
+            ifd = offset + 18
+            relative_to = offset + 10
+        else:
+            ifd = offset
+            relative_to = None
+        serial = None
+        for tag, ftype, vcount, voffset in reader.entries(ifd):
+            # both of these are called SerialNumber, and the last one wins
+            if tag in (0x001D, 0x00A0):
+                if ftype != _ASCII:
+                    raise Unsupported("unexpected SerialNumber type")
+                if relative_to is not None and vcount > 4:
+                    # pointers are relative to the embedded TIFF header
+                    voffset = voffset + relative_to
+                serial = reader.value(ftype, vcount, voffset)
+        return serial
+    elif make.startswith("OLYMPUS"):
+        raise Unsupported("Olympus MakerNote")
+    elif make == "Canon":
+        serial = None
+        for tag, ftype, vcount, voffset in reader.entries(offset):
+            if tag == 0x000C:
+                serial = reader.value(ftype, vcount, voffset)
+        return serial
+    # exifread doesn't find a SerialNumber in any of the other makes
+    return None
+
+
+def _find_jpeg_exif(fh, head):
+    """
+    Returns the offset of the TIFF header inside the APP1 segment of a JPEG.
+    """
+    pos = 2
+    while True:
+        if pos + 4 > len(head):
+            fh.seek(pos)
+            marker = fh.read(4)
+        else:
+            marker = head[pos:pos + 4]
+        if len(marker) < 4 or marker[0] != 0xFF:
+            raise Unsupported("bad JPEG marker")
+        if marker[1] in (0xD9, 0xDA):
+            raise Unsupported("no EXIF before image data")
+        length = struct.unpack(">H", marker[2:4])[0]
+        if marker[1] == 0xE1:
+            if pos + 10 > len(head):
+                fh.seek(pos + 4)
+                ident = fh.read(6)
+            else:
+                ident = head[pos + 4:pos + 10]
+            if ident == b"Exif\x00\x00":
+                return pos + 10
+        pos += 2 + length
+
+
+def read_header(fh):
+    r"""
+    Reads the tags from an open file, raising Unsupported if it can't.
+    :param fh: file opened in binary mode
+    :returns: dictionary of (exifread tag name -> string value)
+
+    >>> import io
+    >>> tiff = b"II*\x00\x08\x00\x00\x00\x01\x00"
+    >>> tiff += b"\x0f\x01\x02\x00\x04\x00\x00\x00Abc\x00\x00\x00\x00\x00"
+    >>> read_header(io.BytesIO(tiff))
+    {'Image Make': 'Abc'}
+    >>> read_header(io.BytesIO(b"GIF89a")) #doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+        ...
+    Unsupported: not a JPEG or TIFF file
+    """
+    head = fh.read(HEAD_SIZE)
+    if head[0:2] == b"\xff\xd8":
+        base = _find_jpeg_exif(fh, head)
+    elif head[0:4] in (b"MM\x00*", b"II*\x00"):
+        base = 0
+    else:
+        raise Unsupported("not a JPEG or TIFF file")
+    return _read_tiff(_TiffReader(fh, head, base))
+
+
+def read_tags(filename):
+    """
+    Get the EXIF tags importpics cares about, reading as little of the file as
+    possible, and falling back to exifread for anything unusual.
+    :param filename: path of a JPEG or TIFF based raw file
+    :returns: dictionary of (exifread tag name -> string value)
+    """
+    with open(filename, 'rb') as f:
+        try:
+            return read_header(f)
+        except (Unsupported, struct.error) as ex:
+            logger.debug("using exifread for {}: {}".format(filename, ex))
+        f.seek(0)
+        tags = exifread.process_file(f)
+    return { tag: str(tags[tag]) for tag in WANTED_TAGS if tag in tags }
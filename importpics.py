@@ -3,8 +3,9 @@
 Copies picture files taken by a camera from removable media like
 flash, automatically creating new folders based on dates.
 
-Warning: this has to read all filenames into memory at once (in
-order to match jpg and nef files together, etc)
+The card is read one directory at a time (files for the same picture, like
+a jpg and a nef, are always in the same directory), so it doesn't have to
+hold every filename on the card in memory at once.
 
 TODO: not sure how the file size checking code will behave with a network file
 system....
@@ -12,65 +13,302 @@ system....
 
 # STL
 import argparse
+import array
+import bisect
 import collections
+import concurrent.futures
+import contextlib
 import datetime
 import hashlib
+import json
 import logging
+import math
 import os
-import pathlib
+import queue
 import re
-import shlex
 import shutil
+import sqlite3
 import sys
+import threading
 import time
 import traceback
 
 # LIB
-import exifread
 from dateutil.parser import parse
 
 # PROJ
 import diskutil
+import fastcopy
+import fastexif
+from library import LibraryIndex, walk_library
+from metacache import MetadataCache
 
 YYMMDD = "%y%m%d"
 
+logger = logging.getLogger("importpics")
+
+# files we know how to read EXIF metadata from, in order of preference
+EXIF_EXTENSIONS = [".jpg", ".nef", ".tif", ".tiff"]
+
 try: raw_input = input
 except NameError: pass
 
 
+class Histogram:
+    """
+    Latency histogram with power of two buckets (in milliseconds).
+
+    >>> h = Histogram()
+    >>> for ms in [0.1, 3, 3, 5, 700]:
+    ...     h.add(ms / 1000.0)
+    >>> h.count, h.percentile(50), h.percentile(100)
+    (5, 4.0, 1024.0)
+    >>> h.to_dict()["buckets"]
+    {'0.25': 1, '4': 2, '8': 1, '1024': 1}
+    """
+    # upper bounds of the buckets, in ms: 0.25, 0.5, 1, 2, ... 65536, then inf
+    BOUNDS = [math.pow(2, i) for i in range(-2, 17)] + [float("inf")]
+
+    def __init__(self):
+        self.counts = [0] * len(Histogram.BOUNDS)
+        self.count = 0
+        self.total = 0.0 # seconds
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000.0
+        self.counts[bisect.bisect_left(Histogram.BOUNDS, ms)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, pct):
+        """
+        :returns: upper bound (in ms) of the bucket the percentile falls in
+        """
+        target = self.count * pct / 100.0
+        seen = 0
+        for bound, n in zip(Histogram.BOUNDS, self.counts):
+            seen += n
+            if n and seen >= target:
+                return bound
+        return None
+
+    def to_dict(self):
+        def fmt(bound):
+            return "inf" if math.isinf(bound) else "{:g}".format(bound)
+        return {
+            "count": self.count,
+            "mean_ms": self.total * 1000.0 / self.count if self.count else None,
+            "max_ms": self.max * 1000.0,
+            "p50_ms": self.percentile(50),
+            "p90_ms": self.percentile(90),
+            "p99_ms": self.percentile(99),
+            "buckets": { fmt(b): n for b, n in zip(Histogram.BOUNDS, self.counts) if n },
+        }
+
+
 class Metrics:
     """
     Tracks metrics like how long it took to run, and how many files were copied.
+    The inc_*() and add_*() methods are safe to call from several threads.
     """
     def __init__(self):
+        self.lock = threading.Lock()
         self.started = int(time.time())
         self.total_seen = None
         self.already_copied = None
         self.too_old = None
         self.copied = 0
+        self.verified = None # copies that were read back and matched the source digest
+        self.cloned = None # copies that were reflinked or hardlinked instead (--clone, --dedup link)
         self.failed = []
         self.file_existed = [] # not in copy log, but existed with correct size
+        self.duplicates = [] # already in the library under another name (--dedup)
 
         self.start_disk_avail = None # in bytes
         self.end_disk_avail = None
         self.alt_folders = []
 
+        # --verify
+        self.hashed = None # library files that were hashed
+        self.unchanged = None # library files with the same size and mtime as when they were hashed
+        self.mismatched = [] # library files whose data doesn't match the digest recorded for them
+        self.changed = [] # library files whose size or mtime changed since they were hashed
+        self.missing = [] # library files that were recorded, but are gone
+
+        self.bytes_copied = 0
+        self.bytes_skipped = 0 # planned, but already at the destination
+        self.bytes_cloned = 0
+        self.throttle_wait = None # seconds copies waited for --max-read-mbps and --max-write-mbps
+        self.groups_done = 0 # groups try_copy() is finished with (copied, skipped or failed)
+        self.files_done = 0
+        self.phases = collections.OrderedDict() # name -> {"wall": sec, "cpu": sec, "bytes": n}
+        self.devices = {} # source device ("major:minor") -> {"files": n, "bytes": n, "seconds": sec}
+        self.latency = { "exif": Histogram(), "copy": Histogram() } # per file
+
     def inc_already_copied(self, items = None):
         items = items or [1]
-        if self.already_copied is None:
-            self.already_copied = 0
-        self.already_copied += len(items)
+        with self.lock:
+            if self.already_copied is None:
+                self.already_copied = 0
+            self.already_copied += len(items)
 
     def inc_too_old(self, items = None):
         items = items or [1]
-        if self.too_old is None:
-            self.too_old = 0
-        self.too_old += len(items)
+        with self.lock:
+            if self.too_old is None:
+                self.too_old = 0
+            self.too_old += len(items)
 
     def inc_copied(self, items = None):
         items = items or [1]
-        self.copied = self.copied or 0
-        self.copied += len(items)
+        with self.lock:
+            self.copied = self.copied or 0
+            self.copied += len(items)
+
+    def inc_verified(self, items = None):
+        items = items or [1]
+        with self.lock:
+            self.verified = self.verified or 0
+            self.verified += len(items)
+
+    def record_clone(self, nbytes):
+        """
+        Records one file that was cloned instead of copied (it is counted in
+        `copied` as well)
+        """
+        with self.lock:
+            self.cloned = (self.cloned or 0) + 1
+            self.bytes_cloned += nbytes
+
+    def add_throttle_wait(self, seconds):
+        with self.lock:
+            self.throttle_wait = (self.throttle_wait or 0.0) + seconds
+
+    def effective_mb_per_sec(self):
+        """
+        :returns: data copied per second of the copy phase, waits included
+        """
+        with self.lock:
+            copy = self.phases.get("copy")
+            return Metrics.mb_per_sec(self.bytes_copied, copy["wall"] if copy else None)
+
+    def add_failed(self, path):
+        with self.lock:
+            self.failed.append(path)
+
+    def add_file_existed(self, path):
+        with self.lock:
+            self.file_existed.append(path)
+
+    def add_duplicates(self, paths):
+        with self.lock:
+            self.duplicates.extend(paths)
+
+    def add_skipped_bytes(self, nbytes):
+        with self.lock:
+            self.bytes_skipped += nbytes
+
+    def inc_groups_done(self, files):
+        with self.lock:
+            self.groups_done += 1
+            self.files_done += files
+
+    def add_alt_folder(self, folder):
+        with self.lock:
+            if folder not in self.alt_folders:
+                self.alt_folders.append(folder)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Times a phase of the import (wall clock and CPU time of the process).
+        Using the same name again adds to the time of that phase.
+        """
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            with self.lock:
+                p = self.phases.setdefault(name, {"wall": 0.0, "cpu": 0.0, "bytes": 0})
+                p["wall"] += wall
+                p["cpu"] += cpu
+
+    def add_phase_bytes(self, name, nbytes):
+        with self.lock:
+            self.phases.setdefault(name, {"wall": 0.0, "cpu": 0.0, "bytes": 0})["bytes"] += nbytes
+
+    def observe(self, what, seconds):
+        """
+        Adds one file to a latency histogram ("exif" or "copy")
+        """
+        with self.lock:
+            self.latency[what].add(seconds)
+
+    def record_copy(self, nbytes, seconds, device = None):
+        """
+        Records one copied file
+        :param device: st_dev of the source file
+        """
+        with self.lock:
+            self.bytes_copied += nbytes
+            self.latency["copy"].add(seconds)
+            if device is not None:
+                name = "{}:{}".format(os.major(device), os.minor(device))
+                d = self.devices.setdefault(name, {"files": 0, "bytes": 0, "seconds": 0.0})
+                d["files"] += 1
+                d["bytes"] += nbytes
+                d["seconds"] += seconds
+
+    @staticmethod
+    def mb_per_sec(nbytes, seconds):
+        if not nbytes or not seconds:
+            return None
+        return nbytes / (1024.0 * 1024.0) / seconds
+
+    def to_json(self):
+        """
+        :returns: the metrics as a dictionary that can be serialized as JSON
+        """
+        effective = self.effective_mb_per_sec()
+        with self.lock:
+            phases = collections.OrderedDict()
+            for name, p in self.phases.items():
+                phases[name] = dict(p, mb_per_sec=Metrics.mb_per_sec(p["bytes"], p["wall"]))
+            devices = {}
+            for name, d in self.devices.items():
+                devices[name] = dict(d, mb_per_sec=Metrics.mb_per_sec(d["bytes"], d["seconds"]))
+            return {
+                "started": self.started,
+                "elapsed": time.time() - self.started,
+                "total_seen": self.total_seen,
+                "already_copied": self.already_copied,
+                "too_old": self.too_old,
+                "copied": self.copied,
+                "verified": self.verified,
+                "cloned": self.cloned,
+                "failed": list(self.failed),
+                "file_existed": len(self.file_existed),
+                "duplicates": len(self.duplicates),
+                "alt_folders": list(self.alt_folders),
+                "hashed": self.hashed,
+                "unchanged": self.unchanged,
+                "mismatched": list(self.mismatched),
+                "changed": list(self.changed),
+                "missing": list(self.missing),
+                "start_disk_avail": self.start_disk_avail,
+                "end_disk_avail": self.end_disk_avail,
+                "bytes_copied": self.bytes_copied,
+                "bytes_skipped": self.bytes_skipped,
+                "bytes_cloned": self.bytes_cloned,
+                "throttle_wait": self.throttle_wait,
+                "effective_mb_per_sec": effective,
+                "phases": phases,
+                "devices": devices,
+                "latency": { k: h.to_dict() for k, h in self.latency.items() },
+            }
 
     def __str__(self):
         lines = []
@@ -80,10 +318,29 @@ class Metrics:
             if count is not None:
                 lines.append(msg.format(count))
         lines.append("Files copied successfully: {}".format(self.copied))
+        p("Files verified after copying: {}", self.verified)
+        p("Files cloned instead of copied: {}", self.cloned)
+        if self.bytes_copied:
+            lines.append("Data copied: {}".format(diskutil.human_readable(self.bytes_copied)))
+        if self.bytes_cloned:
+            lines.append("Data cloned: {}".format(diskutil.human_readable(self.bytes_cloned)))
+        if self.throttle_wait is not None:
+            line = "Time waiting for the bandwidth limits: {:.1f}s".format(self.throttle_wait)
+            effective = self.effective_mb_per_sec()
+            if effective:
+                line += " (effective rate {:.1f} MB/s)".format(effective)
+            lines.append(line)
+        for name, ph in self.phases.items():
+            line = "Time spent in {}: {:.1f}s ({:.1f}s CPU)".format(name, ph["wall"], ph["cpu"])
+            if ph["bytes"] and ph["wall"]:
+                line += " at {:.1f} MB/s".format(Metrics.mb_per_sec(ph["bytes"], ph["wall"]))
+            lines.append(line)
         lines.append("")
         p("Total picture files found: {}", self.total_seen)
         p("Already copied: {}", self.already_copied)
         p("Skipped because files already existed: {}", len(self.file_existed))
+        if self.duplicates:
+            lines.append("Already in the library under another name: {}".format(len(self.duplicates)))
         p("Too old to copy: {}", self.too_old)
         lines.append("Files failed to copy: {}".format(len(self.failed)))
         for f in self.failed:
@@ -100,6 +357,141 @@ class Metrics:
                 lines.append("\t{}".format(f))
         return "\n".join(lines)
 
+    def verify_report(self):
+        """
+        The results of --verify, for people
+        """
+        lines = []
+        def files(msg, paths):
+            lines.append(msg.format(len(paths)))
+            for f in paths:
+                lines.append("\t{}".format(f))
+        verify = self.phases.get("verify", {"wall": 0.0, "cpu": 0.0, "bytes": 0})
+        line = "Files hashed: {} ({})".format(self.hashed or 0, diskutil.human_readable(verify["bytes"]))
+        if verify["bytes"] and verify["wall"]:
+            line += " in {:.1f}s at {:.1f} MB/s".format(verify["wall"], Metrics.mb_per_sec(verify["bytes"], verify["wall"]))
+        lines.append(line)
+        lines.append("Files unchanged since they were last hashed: {}".format(self.unchanged or 0))
+        files("Files that don't match their digest: {}", self.mismatched)
+        files("Files changed since they were last hashed: {}", self.changed)
+        files("Files missing: {}", self.missing)
+        files("Files that could not be read: {}", self.failed)
+        return "\n".join(lines)
+
+class Progress:
+    """
+    Reports the progress of the copy from a background thread, every
+    `interval` seconds:  bytes and groups done out of the plan, the current
+    (last few seconds) and average throughput, and the time left.  It only
+    reads the counters in Metrics, so copying a file costs nothing extra.
+
+    On a terminal the line is rewritten in place every second, otherwise a
+    line is printed every 30 seconds.
+
+    >>> import io
+    >>> metrics = Metrics()
+    >>> progress = Progress(metrics, interval=1, stream=io.StringIO())
+    >>> copyplan = CopyPlan(1)
+    >>> copyplan.groups_to_copy, copyplan.bytes_to_copy, copyplan.files_to_copy = [None] * 200, 1000 * 1024 * 1024, 400
+    >>> progress.begin(copyplan, now=0.0)
+    >>> metrics.bytes_copied, metrics.groups_done, metrics.files_done = 250 * 1024 * 1024, 50, 100
+    >>> progress.line(now=10.0)
+    'Copied 250MB of 1000MB (25%), 50/200 pictures, 100/400 files, 25.0 MB/s now, 25.0 MB/s average, 0:00:30 left'
+    >>> copyplan.planning = True
+    >>> progress.line(now=20.0)
+    'Copied 250MB of 1000MB+ (25%), 50/200+ pictures, 100/400+ files, 0.0 MB/s now, 12.5 MB/s average'
+
+    The totals are read from the plan every time, so they keep up with a
+    plan that is still growing (copy_pipelined()); they are marked with a +
+    until it is complete.
+    """
+    TTY_INTERVAL = 1.0
+    LINES_INTERVAL = 30.0
+    RATE_WINDOW = 10.0 # seconds the current throughput is averaged over
+
+    def __init__(self, metrics, interval = None, stream = None):
+        self.metrics = metrics
+        self.stream = stream or sys.stderr
+        self.tty = self.stream.isatty()
+        self.interval = interval or (Progress.TTY_INTERVAL if self.tty else Progress.LINES_INTERVAL)
+        self.samples = collections.deque() # (time, bytes copied)
+        self.started = None
+        self.copyplan = None
+        self.bytes_before = self.copied_before = self.groups_before = self.files_before = 0
+        self.width = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def begin(self, copyplan, now = None):
+        self.started = time.monotonic() if now is None else now
+        self.copyplan = copyplan
+        # the counters may not start at zero, e.g. after an earlier copy_all()
+        m = self.metrics
+        self.bytes_before = m.bytes_copied + m.bytes_skipped + m.bytes_cloned
+        self.copied_before = m.bytes_copied
+        self.groups_before, self.files_before = m.groups_done, m.files_done
+        self.samples.clear()
+        self.samples.append((self.started, m.bytes_copied))
+
+    def line(self, now = None):
+        now = time.monotonic() if now is None else now
+        m = self.metrics
+        copied = m.bytes_copied
+        done = copied + m.bytes_skipped + m.bytes_cloned - self.bytes_before
+
+        self.samples.append((now, copied))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= Progress.RATE_WINDOW:
+            self.samples.popleft()
+        then, copied_then = self.samples[0]
+        current = Metrics.mb_per_sec(copied - copied_then, now - then) or 0.0
+        average = Metrics.mb_per_sec(copied - self.copied_before, now - self.started) or 0.0
+
+        total_bytes = self.copyplan.bytes_to_copy
+        more = "+" if self.copyplan.planning else ""
+        pct = 100.0 * done / total_bytes if total_bytes else 100.0
+        line = "Copied {} of {}{} ({:.0f}%), {}/{}{} pictures, {}/{}{} files, {:.1f} MB/s now, {:.1f} MB/s average".format(
+            diskutil.human_readable(done), diskutil.human_readable(total_bytes), more, pct,
+            m.groups_done - self.groups_before, len(self.copyplan.groups_to_copy), more,
+            m.files_done - self.files_before, self.copyplan.files_to_copy, more,
+            current, average,
+        )
+        rate = current or average
+        if rate and done < total_bytes and not more:
+            left = (total_bytes - done) / (rate * 1024 * 1024)
+            line += ", {} left".format(datetime.timedelta(seconds=int(left)))
+        return line
+
+    def show(self, final = False):
+        line = self.line()
+        if self.tty:
+            self.stream.write("\r" + line.ljust(self.width) + ("\n" if final else ""))
+            self.width = len(line)
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.show()
+
+    @contextlib.contextmanager
+    def reporting(self, copyplan):
+        """
+        Reports progress while the body copies the groups in copyplan
+        """
+        self.begin(copyplan)
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="progress", daemon=True)
+        self.thread.start()
+        try:
+            yield self
+        finally:
+            self.stopped.set()
+            self.thread.join()
+            if self.tty:
+                self.show(final=True)
+
+
 def prompt(msg, default):
     """
     Displays a prompt and returns user input.
@@ -160,14 +552,11 @@ def confirmOrDie(msg, autoyes):
         print("Aborting")
         sys.exit(1)
 
-def get_destpath(logger, cfgfolder, cfgfile, autoyes):
+def read_destpath(cfgfolder, cfgfile):
     """
-    Determine the parent destination path (under with all of the day and camera
-    specific subfolders are placed).
+    :returns: the destination path saved by get_destpath(), or None
     """
-    cfgfolder = os.path.expanduser(cfgfolder)
-    cfgfile = os.path.join(cfgfolder, cfgfile)
-
+    cfgfile = os.path.join(os.path.expanduser(cfgfolder), cfgfile)
     destpath = None
     if os.path.isfile(cfgfile):
         with open(cfgfile, 'r') as f:
@@ -175,6 +564,17 @@ def get_destpath(logger, cfgfolder, cfgfile, autoyes):
         for line in lines:
             if line.startswith("destpath="):
                 destpath = os.path.expanduser(line.split("=")[1])
+    return destpath
+
+
+def get_destpath(logger, cfgfolder, cfgfile, autoyes):
+    """
+    Determine the parent destination path (under with all of the day and camera
+    specific subfolders are placed).
+    """
+    cfgfolder = os.path.expanduser(cfgfolder)
+    destpath = read_destpath(cfgfolder, cfgfile)
+    cfgfile = os.path.join(cfgfolder, cfgfile)
     chosen_path = prompt("Enter path to copy files to", destpath)
 
     chosen_path = os.path.expanduser(chosen_path)
@@ -203,12 +603,20 @@ def get_destpath(logger, cfgfolder, cfgfile, autoyes):
 def choose_volume(volumes):
     """
     Prompts the user to select with path to import pictures from.
+    :param volumes: list of diskutil.Volumes
+    :returns: path of the chosen volume
     """
+    if not volumes:
+        print("no removable disks found")
+        sys.exit(1)
     print("select which disk to import from (or ctrl+c to exit)")
     choices = {}
     for i, item in enumerate(volumes):
-        choices[i] = item
-        print("{}) {}".format(i, item))
+        choices[i] = item.path
+        details = "{} free of {}".format(diskutil.hr(item.avail), diskutil.hr(item.size))
+        if item.fstype:
+            details = "{}, {}".format(item.fstype, details)
+        print("{}) {} ({})".format(i, item.path, details))
 
     while True:
         try:
@@ -249,6 +657,44 @@ def all_pics(path, extensions = None):
     return pics
 
 
+def walk_groups(path, extensions = None, skip = None):
+    """
+    Streaming version of all_pics() that also does the grouping:  yields a
+    FileGroup for each picture as soon as the directory it is in has been
+    listed, instead of building a list of every file on the card first.
+    Directories and files are visited in sorted order.
+    :param skip: optional set of folders not to walk (joined to path the way
+        os.path.join() does, e.g. <path>/DCIM/100NIKON)
+    """
+    extensions = extensions or ["jpg", "nef", "png", "gif", "tiff"]
+    skip = skip or set()
+    stack = [path]
+    while stack:
+        folder = stack.pop()
+        groups = {}
+        subdirs = []
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        if not entry.is_symlink() and not entry.name.startswith(".") and entry.path not in skip:
+                            subdirs.append(entry.path)
+                    elif ext_match(entry.name, extensions):
+                        base = FileGroup.basepath(entry.path)
+                        if base not in groups:
+                            groups[base] = FileGroup()
+                        try:
+                            st = entry.stat() # no extra system call on Windows
+                        except OSError:
+                            st = None # looked up again when it is needed
+                        groups[base].append(entry.path, st)
+        except OSError:
+            continue # os.walk() ignores directories it can't list, too
+        for base in sorted(groups.keys()):
+            yield groups[base]
+        stack.extend(sorted(subdirs, reverse=True))
+
+
 def cam_hash(tags):
     """
     Creates a string that should uniquely identify the camera.  Since this file
@@ -295,16 +741,17 @@ def exif_date(tags):
 
 def exif_tags(filename):
     """
-    Get the EXIF metadata from a JPG
-    :param filename: absolute path of the jpg, as a string
-    :returns: dictionary of (exif tag name -> tag object)
+    Get the EXIF metadata from a JPG, or from a TIFF based raw file like a NEF.
+    Only the tags needed for get_dest_subfolder() and exif_date() are read.
+    :param filename: absolute path of the picture, as a string
+    :returns: dictionary of (exif tag name -> tag value as a string)
     """
-    if not filename.lower().endswith("jpg"):
+    if not ext_match(filename, EXIF_EXTENSIONS):
         raise ValueError
-    with open(filename, 'rb') as f:
-        tags = exifread.process_file(f)
-    return tags
-    # Convenient way to list them:
+    return fastexif.read_tags(filename)
+    # Convenient way to list all of them:
+    # with open(filename, 'rb') as f:
+    #     tags = exifread.process_file(f)
     # for tag in tags.keys():
     #     if len(str(tags[tag])) < 1024:
     #         print(tag, str(tags[tag]))
@@ -330,19 +777,45 @@ class CopyLog:
     to a flash card by a digital camera is always unique.
 
     A copy log is written every time this program is run, and saved in a
-    folder.  All of those logs are read by this classes and the
-    previously-copied paths are merged into a single set to make it easy
-    to test if a source file has already been copied.
+    folder.  When the run finishes its log is folded into an indexed SQLite
+    database (copylog.db) in the same folder, which is what already_copied()
+    checks, so the whole history never has to be loaded into memory.
+
+    Each line of a log is the path of a copied file, optionally followed by a
+    tab, the digest of its data (see --hash), another tab, and the path it
+    was copied to.  Older
+    logs that have not been compacted into the database yet (see compact())
+    are still read and merged into a set, like they always were.
+
+    >>> import tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> with open(os.path.join(folder, "copiedfiles.99999999.1.log"), "w") as f:
+    ...     _ = f.write("/card/a.jpg\\n")
+    >>> with CopyLog.load(folder) as copylog:
+    ...     copylog.already_copied("/card/a.jpg"), copylog.already_copied("/card/b.jpg")
+    ...     copylog.add("/card/b.jpg", "blake2b:1234", "/pics/200102_nik123456/b.jpg")
+    (True, False)
+    >>> CopyLog.compact(folder)
+    (1, 1)
+    >>> CopyLog.compact(os.path.join(folder, "missing"))
+    (0, 0)
+    >>> with CopyLog.load(folder) as copylog:
+    ...     len(copylog.copied_files), copylog.already_copied("/card/a.jpg", "/card/b.jpg")
+    ...     copylog.db.execute("SELECT digest FROM copied WHERE path = '/card/b.jpg'").fetchone()
+    (0, True)
+    ('blake2b:1234',)
     """
     def __init__(self, folder):
-        self.copied_files = set()
+        self.copied_files = set() # from logs that are not in the database yet
         self.folder = folder
         logfile = "copiedfiles.{}.{}.log".format(
             os.getpid(),
-            int(time.time()),
+            CopyLog.new_stamp(),
         )
         self.logfile = os.path.join(folder, logfile)
         self.fh = None
+        self.lock = threading.Lock()
+        self.db = CopyLog.open_db(folder)
 
     def __enter__(self):
         self.fh = open(self.logfile, 'a')
@@ -351,22 +824,171 @@ class CopyLog:
     def __exit__(self, extype, exval, trace):
         self.fh.flush()
         self.fh.close()
+        with self.lock:
+            CopyLog.fold(self.db, self.folder, self.logfile)
+            self.db.close()
 
-    def add(self, copied_path):
+    def add(self, copied_path, digest = None, dest = None):
         if self.fh is None:
             raise Exception("must call __enter__ before calling add")
-        self.fh.write(copied_path)
-        self.fh.write("\n")
+        line = copied_path
+        if digest or dest:
+            line = "\t".join([copied_path, digest or "", dest or ""])
+        with self.lock:
+            self.fh.write(line)
+            self.fh.write("\n")
+
+    def sync(self):
+        """
+        Makes sure everything added so far is on disk
+        """
+        with self.lock:
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
 
     def already_copied(self, *copied_path):
         if len(copied_path) < 1:
             raise ValueError()
 
         for path in copied_path:
-            if not path in self.copied_files:
+            if path in self.copied_files:
+                continue
+            with self.lock:
+                row = self.db.execute("SELECT 1 FROM copied WHERE path = ?", (path,)).fetchone()
+            if row is None:
                 return False
         return True
 
+    def copied_to(self, copied_path):
+        """
+        :returns: where the file was copied to, or None if that wasn't
+            logged (or it wasn't copied)
+        """
+        with self.lock:
+            row = self.db.execute("SELECT dest FROM copied WHERE path = ?", (copied_path,)).fetchone()
+        return row[0] if row else None
+
+    stamp_lock = threading.Lock()
+    last_stamp = 0
+
+    @staticmethod
+    def new_stamp():
+        """
+        The time, in seconds, but never the same twice in this process, so
+        that several imports running at once (--watch) get their own logs.
+        """
+        with CopyLog.stamp_lock:
+            CopyLog.last_stamp = max(int(time.time()), CopyLog.last_stamp + 1)
+            return CopyLog.last_stamp
+
+    @staticmethod
+    def open_db(folder):
+        db = sqlite3.connect(os.path.join(folder, "copylog.db"), check_same_thread=False, timeout=30)
+        db.execute("CREATE TABLE IF NOT EXISTS copied (path TEXT PRIMARY KEY) WITHOUT ROWID")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS cards (
+                card TEXT NOT NULL,
+                folder TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                cutoff TEXT NOT NULL,
+                PRIMARY KEY (card, folder)
+            ) WITHOUT ROWID""")
+        columns = [row[1] for row in db.execute("PRAGMA table_info(copied)")]
+        for column in ["digest", "dest"]:
+            if column not in columns:
+                db.execute("ALTER TABLE copied ADD COLUMN {} TEXT".format(column))
+        db.execute("CREATE INDEX IF NOT EXISTS copied_dest ON copied (dest)")
+        return db
+
+    @staticmethod
+    def read_log(logfile):
+        """
+        :returns: list of (path, digest, dest) tuples, where digest and dest
+            are None if they weren't recorded
+        """
+        entries = []
+        with open(logfile, 'r') as f:
+            for line in f:
+                fields = [field.strip() or None for field in line.split("\t")]
+                if fields[0]:
+                    fields += [None] * (3 - len(fields))
+                    entries.append(tuple(fields[0:3]))
+        return entries
+
+    @staticmethod
+    def fold(db, folder, logfile):
+        """
+        Moves the entries of a text log into the database, and then moves the
+        log into the "compacted" subfolder (it is kept, but never read again).
+        :returns: the number of entries in the log
+        """
+        entries = CopyLog.read_log(logfile)
+        # a digest belongs to the copy it was taken of, so a file that was
+        # copied again somewhere else (see --dedup) doesn't keep the old one
+        db.executemany("""
+            INSERT INTO copied (path, digest, dest) VALUES (?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET
+                digest = CASE WHEN excluded.dest IS NOT dest AND excluded.dest IS NOT NULL
+                    THEN excluded.digest ELSE coalesce(excluded.digest, digest) END,
+                dest = coalesce(excluded.dest, dest)
+            """, entries)
+        db.commit()
+        compacted = os.path.join(folder, "compacted")
+        if not os.path.isdir(compacted):
+            os.makedirs(compacted)
+        os.rename(logfile, os.path.join(compacted, os.path.basename(logfile)))
+        return len(entries)
+
+    @staticmethod
+    def legacy_logs(folder):
+        """
+        :returns: the text logs in the folder that are not in the database yet
+        """
+        logs = []
+        for e in sorted(os.listdir(folder)):
+            fn = os.path.join(folder, e)
+            if os.path.isfile(fn) and fn.lower().endswith(".log"):
+                logs.append(fn)
+        return logs
+
+    @staticmethod
+    def compact(folder):
+        """
+        Folds all of the text logs in the folder into the database, except for
+        logs still being written by another running import.
+        :returns: tuple of (number of logs, number of entries) folded
+        """
+        folder = os.path.expanduser(folder)
+        if not os.path.isdir(folder):
+            return 0, 0 # nothing was ever logged there
+        db = CopyLog.open_db(folder)
+        files, entries = 0, 0
+        try:
+            for fn in CopyLog.legacy_logs(folder):
+                if CopyLog.log_in_use(fn):
+                    continue
+                entries += CopyLog.fold(db, folder, fn)
+                files += 1
+        finally:
+            db.close()
+        return files, entries
+
+    @staticmethod
+    def log_in_use(logfile):
+        """
+        True if the log was created by another process that is still running
+        """
+        m = re.match(r"^copiedfiles\.(\d+)\.\d+\.log$", os.path.basename(logfile))
+        if not m or int(m.group(1)) == os.getpid():
+            return False
+        try:
+            os.kill(int(m.group(1)), 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+
     @staticmethod
     def load(folder):
         folder = os.path.expanduser(folder)
@@ -374,15 +996,424 @@ class CopyLog:
             os.makedirs(folder)
 
         clog = CopyLog(folder)
-        entries = os.listdir(folder)
-        for e in entries:
-            fn = os.path.join(folder, e)
-            if os.path.isfile(fn) and fn.lower().endswith(".log"):
-                with open(fn, 'r') as f:
-                    lines = [line.strip() for line in f.readlines()]
-                    clog.copied_files.update(lines)
+        for fn in CopyLog.legacy_logs(folder):
+            clog.copied_files.update(e[0] for e in CopyLog.read_log(fn))
         return clog
 
+class CardFingerprint:
+    """
+    What the DCF folders of a card (the folders in DCIM) looked like the
+    last time it was imported:  a digest of the names, sizes and
+    modification times of the files in each one, saved in the copy log
+    database under the UUID (or label) of the card.
+
+    When the same card is imported again, the folders that haven't changed
+    don't have to be walked, since everything in them was either copied or
+    too old the last time.  That only holds if the import finished without
+    failures or hitting --number, and if the new import doesn't look back
+    further than that one did, so the lookback cutoff is saved with each
+    folder.  --force ignores them.
+
+    >>> import tempfile
+    >>> card, logs = tempfile.mkdtemp(), tempfile.mkdtemp()
+    >>> for folder in ["100NIKON", "101NIKON"]:
+    ...     os.makedirs(os.path.join(card, "DCIM", folder))
+    ...     open(os.path.join(card, "DCIM", folder, "DSC_0001.JPG"), "w").close()
+    >>> db = CopyLog.open_db(logs)
+    >>> fp = CardFingerprint(card, "uuid:1234-ABCD")
+    >>> sorted(fp.folders), fp.unchanged(db, datetime.date(2020, 1, 1))
+    (['100NIKON', '101NIKON'], set())
+    >>> fp.save(db, datetime.date(2020, 1, 1))
+    >>> open(os.path.join(card, "DCIM", "101NIKON", "DSC_0002.JPG"), "w").close()
+    >>> fp = CardFingerprint(card, "uuid:1234-ABCD")
+    >>> fp.unchanged(db, datetime.date(2020, 1, 2)), fp.unchanged(db, datetime.date(2019, 12, 31))
+    ({'100NIKON'}, set())
+    """
+    def __init__(self, path, card_id = None):
+        self.path = path
+        self.card_id = card_id or diskutil.volume_id(path) or "path:{}".format(os.path.abspath(path))
+        self.folders = {} # DCF folder -> digest of its listing
+        self.saved = {} # DCF folder -> (digest, cutoff) from the last import
+        self.skipped = set() # folders that are not walked this time
+        try:
+            with os.scandir(os.path.join(path, "DCIM")) as it:
+                folders = [e for e in it if e.is_dir() and not e.is_symlink() and not e.name.startswith(".")]
+        except OSError:
+            folders = [] # not a camera card
+        for entry in folders:
+            try:
+                self.folders[entry.name] = CardFingerprint.folder_digest(entry.path)
+            except OSError:
+                pass # it is walked every time
+
+    @staticmethod
+    def folder_digest(folder):
+        entries = []
+        with os.scandir(folder) as it:
+            for entry in it:
+                st = entry.stat(follow_symlinks=False)
+                entries.append("{}/{}/{}/".format(entry.name, st.st_size, st.st_mtime_ns))
+        return hashlib.blake2b("".join(sorted(entries)).encode("utf-8", "surrogateescape"), digest_size=16).hexdigest()
+
+    def digest(self):
+        """
+        :returns: fingerprint of the whole card
+        """
+        h = hashlib.blake2b(self.card_id.encode("utf-8", "surrogateescape"), digest_size=16)
+        for folder, digest in sorted(self.folders.items()):
+            h.update("{}/{}/".format(folder, digest).encode("utf-8", "surrogateescape"))
+        return h.hexdigest()
+
+    def unchanged(self, db, cutoff):
+        """
+        :param cutoff: date of the oldest pictures the import will copy
+        :returns: set of the folders that are the same as when they were
+            imported with the same cutoff or a later one
+        """
+        self.saved = {}
+        for folder, digest, saved_cutoff in db.execute("SELECT folder, digest, cutoff FROM cards WHERE card = ?", (self.card_id,)):
+            self.saved[folder] = (digest, datetime.date.fromisoformat(saved_cutoff))
+        self.skipped = set()
+        for folder, digest in self.folders.items():
+            if folder in self.saved and self.saved[folder][0] == digest and self.saved[folder][1] <= cutoff:
+                self.skipped.add(folder)
+        return self.skipped
+
+    def save(self, db, cutoff):
+        """
+        Records the folders as imported.  The ones that were skipped keep
+        the cutoff they were imported with.
+        """
+        rows = []
+        for folder, digest in self.folders.items():
+            folder_cutoff = self.saved[folder][1] if folder in self.skipped else cutoff
+            rows.append((self.card_id, folder, digest, folder_cutoff.isoformat()))
+        db.execute("DELETE FROM cards WHERE card = ?", (self.card_id,))
+        db.executemany("INSERT INTO cards (card, folder, digest, cutoff) VALUES (?, ?, ?, ?)", rows)
+        db.commit()
+
+    def forget(self, db):
+        db.execute("DELETE FROM cards WHERE card = ?", (self.card_id,))
+        db.commit()
+
+
+class CopyJournal:
+    """
+    Makes copying crash safe, for --journal.
+
+    Each file is copied to a temporary name in its destination folder and
+    staged here.  Staged files are committed in batches ("group commit"): all
+    of them are fsynced, renamed to their real names, their folders are
+    fsynced, and only then are they added to the copy log, which is fsynced
+    too.  So an interrupted import never leaves a truncated file under a real
+    name (which the next run would mistake for a different picture and move to
+    an alternate folder), and anything in the copy log is really on disk,
+    without paying for an fsync after every file.
+
+    >>> import tempfile
+    >>> logs, dest = tempfile.mkdtemp(), tempfile.mkdtemp()
+    >>> metrics = Metrics()
+    >>> with CopyLog(logs) as copylog:
+    ...     journal = CopyJournal(metrics, copylog)
+    ...     tmp = journal.temp_path(os.path.join(dest, "a.jpg"))
+    ...     with open(tmp, "w") as f:
+    ...         _ = f.write("abc")
+    ...     journal.stage("/card/a.jpg", tmp, os.path.join(dest, "a.jpg"))
+    ...     os.listdir(dest), CopyLog.read_log(copylog.logfile)
+    ...     journal.commit()
+    ...     os.listdir(dest), [e[0] for e in CopyLog.read_log(copylog.logfile)]
+    (['.a.jpg.importpics-tmp'], [])
+    (['a.jpg'], ['/card/a.jpg'])
+    >>> metrics.copied
+    1
+    """
+    TEMP_SUFFIX = ".importpics-tmp"
+
+    def __init__(self, metrics, copylog, batch_files = 256, batch_bytes = 1024 * 1024 * 1024, library = None):
+        self.metrics = metrics
+        self.copylog = copylog
+        self.library = library # LibraryIndex the logged files are added to
+        self.batch_files = batch_files
+        self.batch_bytes = batch_bytes
+        self.lock = threading.Lock() # protects staged
+        self.commit_lock = threading.Lock() # only one commit at a time
+        self.staged = [] # (source, temp path, dest path, digest, Metrics of a Backup or None)
+        self.staged_bytes = 0
+        self.logs = {} # staged source -> (digest, dest path) it is logged with when committed
+
+    @staticmethod
+    def temp_path(fdest):
+        folder, name = os.path.split(fdest)
+        return os.path.join(folder, ".{}{}".format(name, CopyJournal.TEMP_SUFFIX))
+
+    def stage(self, src, tmp, fdest, digest = None, backup_metrics = None):
+        """
+        Records a file that was copied to its temporary name, and commits the
+        batch if it is big enough.
+        :param backup_metrics: Metrics of the Backup the file was copied to,
+            if it's not the main destination (only those are logged)
+        """
+        log = (digest, fdest) if backup_metrics is None else None
+        self.stage_all([(src, tmp, fdest, digest, backup_metrics)], log)
+
+    def stage_all(self, entries, log = None):
+        """
+        Stages the copies of one source file to its destinations, in the
+        same batch.  The source is logged once all of them are committed.
+        :param entries: list of the arguments of stage()
+        :param log: (digest, dest path) to log the source with, or None if
+            it must not be logged (it failed to copy to another destination)
+        """
+        with self.lock:
+            self.staged.extend(entries)
+            self.staged_bytes += sum(os.path.getsize(e[1]) for e in entries)
+            if log is not None:
+                self.logs[entries[0][0]] = log
+            full = len(self.staged) >= self.batch_files or self.staged_bytes >= self.batch_bytes
+        if full:
+            self.commit()
+
+    def commit(self):
+        """
+        Makes every staged file durable under its real name, then logs it.
+        When this returns, everything staged before the call is committed.
+        """
+        with self.commit_lock:
+            with self.lock:
+                batch, self.staged, self.staged_bytes = self.staged, [], 0
+                logs = dict((e[0], self.logs.pop(e[0])) for e in batch if e[0] in self.logs)
+            if not batch:
+                return
+
+            done = []
+            for entry in batch:
+                src, tmp, fdest, digest, metrics = entry
+                try:
+                    fd = os.open(tmp, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                    done.append(entry)
+                except OSError:
+                    (metrics or self.metrics).add_failed(fdest)
+                    traceback.print_exc()
+
+            folders = set()
+            for entry in list(done):
+                src, tmp, fdest, digest, metrics = entry
+                try:
+                    os.rename(tmp, fdest)
+                    folders.add(os.path.dirname(fdest))
+                except OSError:
+                    done.remove(entry)
+                    (metrics or self.metrics).add_failed(fdest)
+                    traceback.print_exc()
+            for folder in folders:
+                fd = os.open(folder, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+            for entry in batch:
+                if entry not in done:
+                    logs.pop(entry[0], None)
+            for src, (digest, fdest) in logs.items():
+                self.copylog.add(src, digest, fdest)
+            logged = [e for e in done if e[4] is None]
+            if self.library is not None:
+                for src, tmp, fdest, digest, metrics in logged:
+                    self.library.add(fdest)
+            self.copylog.sync()
+            if logged:
+                self.metrics.inc_copied(logged)
+            for src, tmp, fdest, digest, metrics in done:
+                if metrics is not None:
+                    metrics.inc_copied()
+
+    @staticmethod
+    def cleanup(folder):
+        """
+        Deletes temporary files left in a folder by an interrupted import
+        """
+        if not os.path.isdir(folder):
+            return
+        for e in os.listdir(folder):
+            if e.startswith(".") and e.endswith(CopyJournal.TEMP_SUFFIX):
+                os.remove(os.path.join(folder, e))
+
+
+class Backup:
+    """
+    Another destination that every picture is copied to (--also-copy-to),
+    from the same read of the card as the main destination.  It has its own
+    alternate folders and Metrics.
+    """
+    def __init__(self, destpath):
+        self.destpath = destpath
+        self.metrics = Metrics()
+        self.index = DestIndex(destpath)
+        self.lock = threading.Lock()
+        self.alts = {} # dest_subfolder -> alternate folder
+
+    def alt_folder(self, subfolder):
+        """
+        The alternate folder for pictures that collide in subfolder, picked
+        (like schedule_copy() does for the main destination) the first time
+        it is needed.
+        """
+        with self.lock:
+            if subfolder not in self.alts:
+                self.alts[subfolder] = self.index.alt_folder(subfolder)
+            return self.alts[subfolder]
+
+
+class DestIndex:
+    """
+    What is in the destination folders, so that checking for pictures that
+    are already there, or for files in the way, doesn't need a stat call per
+    file (each one is a round trip on a network share).  Each folder is
+    listed once, with one scandir, the first time it is needed, and files
+    are added as they are copied.  Sizes are only looked up for names that
+    are actually there.
+
+    The listing is a snapshot:  changes made to the destination by anything
+    else while importing are not seen.
+
+    >>> import tempfile
+    >>> dest = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(dest, "200102_nik123456", "DSC_0002.JPG"))
+    >>> os.makedirs(os.path.join(dest, "200102_nik123456_01"))
+    >>> with open(os.path.join(dest, "200102_nik123456", "DSC_0001.JPG"), "w") as f:
+    ...     _ = f.write("abc")
+    >>> index = DestIndex(dest)
+    >>> [index.size("200102_nik123456", n) for n in ["DSC_0001.JPG", "DSC_0002.JPG", "DSC_0003.JPG"]]
+    [3, -1, None]
+    >>> index.alt_folder("200102_nik123456")
+    '200102_nik123456_02'
+    >>> index.makedirs("200102_nik123456_02")
+    >>> index.add("200102_nik123456_02", "DSC_0001.JPG", 5)
+    >>> index.size("200102_nik123456_02", "DSC_0001.JPG"), index.alt_folder("200102_nik123456")
+    (5, '200102_nik123456_03')
+    """
+    DIR = -1 # size of anything that is not a file
+
+    open_indexes = {} # destpath -> [DestIndex, number of users]
+    open_lock = threading.Lock()
+
+    def __init__(self, destpath):
+        self.destpath = destpath
+        self.lock = threading.RLock()
+        self.subfolders = None # names of the folders in destpath
+        self.folders = {} # subfolder -> { name -> size, or DirEntry if not looked up yet }
+        self.st_dev = None
+
+    def device(self):
+        """
+        :returns: st_dev of the destination
+        """
+        with self.lock:
+            if self.st_dev is None:
+                self.st_dev = os.stat(self.destpath).st_dev
+            return self.st_dev
+
+    def exists(self, subfolder):
+        with self.lock:
+            if self.subfolders is None:
+                self.subfolders = set()
+                with os.scandir(self.destpath) as it:
+                    for entry in it:
+                        if entry.is_dir():
+                            self.subfolders.add(entry.name)
+            return subfolder in self.subfolders
+
+    def listing(self, subfolder):
+        with self.lock:
+            if subfolder not in self.folders:
+                entries = {}
+                if self.exists(subfolder):
+                    with os.scandir(os.path.join(self.destpath, subfolder)) as it:
+                        for entry in it:
+                            entries[entry.name] = entry
+                self.folders[subfolder] = entries
+            return self.folders[subfolder]
+
+    def size(self, subfolder, name):
+        """
+        :returns: size of the file, DestIndex.DIR if it's something else, or
+            None if there is nothing with that name
+        """
+        with self.lock:
+            entries = self.listing(subfolder)
+            entry = entries.get(name)
+            if isinstance(entry, os.DirEntry):
+                entry = entries[name] = entry.stat().st_size if entry.is_file() else DestIndex.DIR
+            return entry
+
+    def add(self, subfolder, name, size):
+        with self.lock:
+            self.listing(subfolder)[name] = size
+
+    def makedirs(self, subfolder):
+        with self.lock:
+            if not self.exists(subfolder):
+                os.makedirs(os.path.join(self.destpath, subfolder), exist_ok=True)
+                self.subfolders.add(subfolder)
+                self.folders.setdefault(subfolder, {})
+
+    def alt_folder(self, subfolder):
+        """
+        :returns: the first alternate name for subfolder that isn't used yet
+        """
+        with self.lock:
+            return diskutil.alt_folder(subfolder, exists=self.exists)
+
+    def alt_folders(self, subfolder):
+        """
+        :returns: the alternate folders of subfolder that exist
+        """
+        with self.lock:
+            self.exists(subfolder)
+            pattern = re.compile(re.escape(subfolder) + r"_\d+$")
+            return sorted(f for f in self.subfolders if pattern.match(f))
+
+    @staticmethod
+    @contextlib.contextmanager
+    def shared(destpath):
+        """
+        Uses the same DestIndex as any other import in this process that is
+        copying to destpath at the same time (--watch), so they see each
+        other's files.  It is dropped when the last one finishes.
+        """
+        key = os.path.abspath(destpath)
+        with DestIndex.open_lock:
+            entry = DestIndex.open_indexes.setdefault(key, [DestIndex(destpath), 0])
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with DestIndex.open_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del DestIndex.open_indexes[key]
+
+
+class FileStat(collections.namedtuple("FileStat", ["st_size", "st_mtime_ns", "st_dev"])):
+    """
+    The parts of an os.stat() result that a FileGroup keeps for each file
+    """
+    __slots__ = ()
+
+    @property
+    def st_mtime(self):
+        return self.st_mtime_ns / 1e9
+
+    @staticmethod
+    def of(st):
+        return FileStat(st.st_size, st.st_mtime_ns, st.st_dev)
+
+
 class FileGroup:
     """
     A group of files representing a single picture.
@@ -391,34 +1422,157 @@ class FileGroup:
     It seems that multiple images files might be created for a single image,
     e.g. a jpg and an nef, which will have the same basename and differ only by
     their file extensions.
+
+    There is one of these for every picture on the card, and every picture
+    being copied, so they are kept small:  the folder is shared (interned) by
+    all the groups in it, the extensions are bits of a mask, and the file
+    sizes and modification times are in an array.  Paths are put back
+    together when they are needed.
+
+    >>> fg = FileGroup()
+    >>> fg.append("/card/DCIM/100NIKON/DSC_0001.NEF", FileStat(2000, 0, 1))
+    >>> fg.append("/card/DCIM/100NIKON/DSC_0001.JPG", FileStat(1000, 0, 1))
+    >>> fg.base_path, sorted(fg.files)
+    ('/card/DCIM/100NIKON/DSC_0001', ['/card/DCIM/100NIKON/DSC_0001.JPG', '/card/DCIM/100NIKON/DSC_0001.NEF'])
+    >>> fg.stat(fg.jpg()).st_size, fg.stat("/card/DCIM/100NIKON/DSC_0001.NEF").st_size
+    (1000, 2000)
     """
+    __slots__ = ["folder", "name", "extmask", "stats", "device", "total_bytes", "dest_subfolder", "dest_subfolderalt", "exif_date", "duplicates"]
+
+    extensions = [] # every extension seen so far;  bit i of extmask is extensions[i]
+    extension_bits = {} # extension -> bit
+    extensions_lock = threading.Lock()
+
     def __init__(self):
-        self.files = []
-        self.base_path = None
+        self.folder = None
+        self.name = None # file name without the extension
+        self.extmask = 0
+        self.stats = array.array("q") # size, mtime in ns of each file (in bit order), -1 until looked up
+        self.device = None
         self.total_bytes = None # size in bytes of all files
         self.dest_subfolder = None # the folder with the date and cam hash
         self.dest_subfolderalt = None # alternate folder that did not exist before copying started
         self.exif_date = None # our best guess at the pic date from EXIF metadata
+        self.duplicates = None # file -> path of the same data in the library (--dedup link)
 
-    def append(self, path):
-        self.files.append(path)
-        if self.base_path is None:
-            self.base_path = self.basepath(path)
-        elif self.base_path != self.basepath(path):
+    @staticmethod
+    def extension_bit(ext):
+        bit = FileGroup.extension_bits.get(ext)
+        if bit is None:
+            with FileGroup.extensions_lock:
+                bit = FileGroup.extension_bits.get(ext)
+                if bit is None:
+                    bit = len(FileGroup.extensions)
+                    FileGroup.extensions.append(ext)
+                    FileGroup.extension_bits[ext] = bit
+        return bit
+
+    @property
+    def base_path(self):
+        if self.folder is None:
+            return None
+        return os.path.join(self.folder, self.name)
+
+    @property
+    def files(self):
+        return list(self)
+
+    def append(self, path, st = None):
+        """
+        :param st: os.stat() (or os.DirEntry.stat()) result of the file if
+            the caller has it, otherwise it is looked up when needed
+        """
+        folder, filename = os.path.split(path)
+        name, ext = os.path.splitext(filename)
+        if self.folder is None:
+            self.folder = sys.intern(folder)
+            self.name = name
+        elif self.folder != folder or self.name != name:
             raise Exception("something went wrong")
+        bit = self.extension_bit(ext)
+        if self.extmask & (1 << bit):
+            return
+        self.extmask |= 1 << bit
+        i = 2 * self.position(bit)
+        self.stats[i:i] = array.array("q", [-1, -1] if st is None else [st.st_size, st.st_mtime_ns])
+        if st is not None and st.st_dev:
+            self.device = st.st_dev # DirEntry.stat() leaves it 0 on Windows
+
+    def position(self, bit):
+        """
+        :returns: index of the file with this extension bit among the files
+        """
+        return bin(self.extmask & ((1 << bit) - 1)).count("1")
 
     def __iter__(self):
-        return self.files.__iter__()
+        mask, bit = self.extmask, 0
+        base = self.base_path
+        while mask:
+            if mask & 1:
+                yield base + FileGroup.extensions[bit]
+            mask >>= 1
+            bit += 1
+
+    def stat(self, path):
+        """
+        Size and modification time of one of the files, looked up once
+        :returns: FileStat
+        """
+        bit = FileGroup.extension_bits[os.path.splitext(path)[1]]
+        i = 2 * self.position(bit)
+        if self.stats[i] < 0 or self.device is None:
+            st = os.stat(path)
+            self.stats[i], self.stats[i + 1] = st.st_size, st.st_mtime_ns
+            self.device = st.st_dev
+        return FileStat(self.stats[i], self.stats[i + 1], self.device)
 
     def jpg(self):
         jpgs = [f for f in self.files if f.lower().endswith(".jpg")]
         if len(jpgs) != 1:
             raise Exception("wrong number of jpg files")
         return jpgs[0]
+
+    def dcf_number(self):
+        """
+        The DCF folder and file numbers of the picture, which go up as the
+        camera takes pictures (until it wraps around), or -1 if the names
+        don't follow DCF
+
+        >>> fg = FileGroup()
+        >>> fg.append("/card/DCIM/101NIKON/DSC_0042.JPG")
+        >>> fg.dcf_number()
+        (101, 42)
+        """
+        folder = re.match(r"^(\d{3})", os.path.basename(self.folder))
+        number = re.search(r"(\d{4})$", self.name)
+        return (int(folder.group(1)) if folder else -1, int(number.group(1)) if number else -1)
+
+    def mtime(self):
+        """
+        Latest modification time of the files.  Cameras set it when they
+        write the picture, so it is never earlier than the EXIF date.
+        """
+        return max(self.stat(f).st_mtime for f in self)
+
+    def metadata_file(self):
+        """
+        Picks the file to read EXIF metadata from:  the jpg if there is one,
+        otherwise a raw file (so that raw-only pictures can be dated too).
+        """
+        files = self.files
+        for ext in EXIF_EXTENSIONS:
+            for f in files:
+                if f.lower().endswith(ext):
+                    return f
+        raise Exception("no file with EXIF metadata in {}".format(self.base_path))
                 
     @staticmethod
     def basepath(path):
-        return str(pathlib.Path(path).with_suffix(""))
+        return os.path.splitext(path)[0]
+
+
+DEDUP_MODES = ["skip", "link"] # what --dedup does with pictures that are already in the library
+COPY_ORDERS = ["physical", "plan"] # physical_order(), or the order the pictures were planned in
 
 
 class CopyPlan:
@@ -435,13 +1589,96 @@ class CopyPlan:
         self.force = force
         self.groups_to_copy = []
         self.bytes_to_copy = 0
+        self.files_to_copy = 0
+        self.planning = False # groups are still being added (copy_pipelined())
         self.start_disk_avail = None # avail. diskspace before copy in bytes 
         self.destpath = None
         self.maxpics = maxpics
+        self.copy_backend = fastcopy.DEFAULT_BACKEND # see fastcopy.BACKENDS
+        self.hash_algorithm = None # hash files while copying, see fastcopy.HASH_ALGORITHMS
+        self.verify_copies = False # read back each copy and compare its hash
+        self.journal = False # crash safe copying, see CopyJournal
+        self.clone = None # clone files on the same filesystem instead of copying them, see fastcopy.CLONE_MODES
+        self.dedup = None # what to do with pictures already in the library, see DEDUP_MODES
+        self.max_read_mbps = None # bandwidth limits of the copy, see fastcopy.Throttle
+        self.max_write_mbps = None
+        self.idle_io = False
+        self.drop_cache = False
+        self.copy_order = "physical" # order the plan is copied in, see COPY_ORDERS
+        self.library = None # LibraryIndex of destpath, if it has one
+        self.newest_first = False # plan with plan_newest_first()
+        self.backups = [] # Backups that everything is copied to as well
+        self.pipelined = False # copy while planning, see copy_pipelined()
+        self.alts = {} # dest_subfolder -> alternate folder, see schedule_copy()
+
+    @property
+    def backup_destpaths(self):
+        return [b.destpath for b in self.backups]
+
+    @backup_destpaths.setter
+    def backup_destpaths(self, destpaths):
+        self.backups = [Backup(d) for d in destpaths or []]
 
     def add(self, filegroup):
         self.groups_to_copy.append(filegroup)
         self.bytes_to_copy += filegroup.total_bytes
+        self.files_to_copy += len(filegroup.files)
+
+    SETTINGS = ["lookback_days", "force", "maxpics", "destpath", "copy_backend", "hash_algorithm", "verify_copies", "journal", "backup_destpaths", "clone", "dedup",
+        "max_read_mbps", "max_write_mbps", "idle_io", "drop_cache", "copy_order"]
+
+    def save(self, planfile):
+        """
+        Writes the plan to a file, so that an interrupted import can be
+        finished with --resume.
+        """
+        plan = { k: getattr(self, k) for k in CopyPlan.SETTINGS }
+        plan["started_dt"] = self.started_dt.isoformat()
+        plan["groups"] = [{
+            "files": fg.files,
+            "dest_subfolder": fg.dest_subfolder,
+            "dest_subfolderalt": fg.dest_subfolderalt,
+            "exif_date": fg.exif_date.isoformat(),
+            "total_bytes": fg.total_bytes,
+            "duplicates": fg.duplicates,
+        } for fg in self.groups_to_copy]
+        tmp = planfile + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(plan, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, planfile)
+
+    @staticmethod
+    def load(planfile):
+        with open(planfile, 'r') as f:
+            plan = json.load(f)
+        copyplan = CopyPlan(
+            plan["lookback_days"],
+            datetime.datetime.fromisoformat(plan["started_dt"]),
+            plan["force"],
+            plan["maxpics"],
+        )
+        for k in CopyPlan.SETTINGS:
+            if k in plan:
+                setattr(copyplan, k, plan[k])
+        for g in plan["groups"]:
+            fg = FileGroup()
+            for f in g["files"]:
+                fg.append(f)
+            fg.dest_subfolder = g["dest_subfolder"]
+            fg.dest_subfolderalt = g["dest_subfolderalt"]
+            fg.exif_date = datetime.datetime.fromisoformat(g["exif_date"])
+            fg.total_bytes = g["total_bytes"]
+            fg.duplicates = g.get("duplicates")
+            copyplan.add(fg)
+        return copyplan
+
+    def cutoff(self):
+        """
+        :returns: the date of the oldest pictures in the lookback period
+        """
+        return self.started_dt.date() - datetime.timedelta(days=self.lookback_days)
 
     def in_lookback(self, dt):
         """
@@ -457,139 +1694,1159 @@ class CopyPlan:
         >>> CopyPlan(3, datetime.datetime(2010, 6, 20)).in_lookback(datetime.datetime(2010, 6, 16))
         False
         """
-        return (self.started_dt.date() - dt.date()).days <= self.lookback_days
+        return dt.date() >= self.cutoff()
+
+def picture_info(filename, cache = None, st = None, metrics = None):
+    """
+    Works out the destination subfolder and date of a picture from its EXIF
+    metadata, or from the metadata cache if the file hasn't changed since the
+    last time it was read.
+    :param filename: file to read EXIF metadata from
+    :param cache: optional MetadataCache
+    :param st: os.stat result of the file, if the caller already has it
+    :param metrics: optional Metrics to record the EXIF parsing time in
+    :returns: tuple of (dest_subfolder, exif_date, os.stat result of the file)
+    """
+    st = st or os.stat(filename)
+    if cache is not None:
+        cached = cache.get(filename, st.st_size, st.st_mtime_ns)
+        if cached is not None:
+            dest_subfolder, date, _ = cached
+            return dest_subfolder, date, st
+
+    start = time.perf_counter()
+    tags = exif_tags(filename)
+    if metrics is not None:
+        metrics.observe("exif", time.perf_counter() - start)
+    dest_subfolder = get_dest_subfolder(tags, YYMMDD) # TODO dont re-calculate date twice
+    date = exif_date(tags)
+    if cache is not None:
+        cache.put(filename, st.st_size, st.st_mtime_ns, dest_subfolder, date, cam_hash(tags))
+    return dest_subfolder, date, st
+
+
+def read_group_info(fg, cache = None, metrics = None):
+    """
+    Reads the EXIF metadata and file sizes for a group of files.  This is the
+    slow part of planning (it waits on the card reader) and it only reads the
+    source files, so it is safe to call from a worker thread.
+    :param fg: the group of files to read
+    :param cache: optional MetadataCache
+    :param metrics: optional Metrics to record the EXIF parsing time in
+    :returns: tuple of (dest_subfolder, exif_date, total_bytes)
+    """
+    mfile = fg.metadata_file()
+    dest_subfolder, date, _ = picture_info(mfile, cache, fg.stat(mfile), metrics)
+    total_bytes = 0
+    for f in fg:
+        total_bytes += fg.stat(f).st_size
+    return dest_subfolder, date, total_bytes
+
 
-def schedule_copy(metrics, copyplan, copylog, fg):
+def schedule_copy(metrics, copyplan, copylog, fg, info = None, cache = None, index = None):
     """
     Tries to ensure all pictures files in the file group are copied
     :param copylog: the log that tracks if files have already been copied
     :param fg: object representing the group of files to copy
+    :param info: optional future holding the result of read_group_info(fg),
+        if it was already submitted to a worker pool
+    :param cache: optional MetadataCache
+    :param index: DestIndex of copyplan.destpath (a new one if not given)
+    :returns: True if the group was added to the plan
     """
     if copyplan.maxpics and len(copyplan.groups_to_copy) >= copyplan.maxpics:
         logger.debug("Skipping {} because already at max number".format(fg.base_path))
-        return
+        return False
 
     if (not copyplan.force) and copylog.already_copied(*fg):
-        metrics.inc_already_copied(list(fg))
-        logger.debug("Already copied: {}".format(fg.base_path))
-        return
-
-    tags = exif_tags(fg.jpg())
-    fg.dest_subfolder = get_dest_subfolder(tags, YYMMDD) # TODO dont re-calculate date twice
-    fg.dest_subfolderalt = diskutil.alt_folder(fg.dest_subfolder)
+        if not (copyplan.dedup and replaced_since_copied(copylog, fg)):
+            metrics.inc_already_copied(list(fg))
+            logger.debug("Already copied: {}".format(fg.base_path))
+            return False
+        logger.info("{} is not the picture that was copied from there before (was the card formatted?)".format(fg.base_path))
+        info = None
+
+    if info is None:
+        fg.dest_subfolder, fg.exif_date, total_bytes = read_group_info(fg, cache, metrics)
+    else:
+        fg.dest_subfolder, fg.exif_date, total_bytes = info.result()
 
-    fg.exif_date = exif_date(tags)
     if not copyplan.in_lookback(fg.exif_date):
         metrics.inc_too_old(list(fg))
         logger.debug("Too old to copy: {} was taken on {}".format(fg.base_path, fg.exif_date))
-        return
-
-    fg.total_bytes = 0
-    for f in fg:
-        fsize = os.path.getsize(f)
-        fg.total_bytes += fsize
+        return False
+
+    if copyplan.dedup and copyplan.library is not None:
+        duplicates = find_duplicates(copyplan.library, fg)
+        if copyplan.dedup == "skip" and len(duplicates) == len(fg.files):
+            metrics.add_duplicates(list(fg))
+            for f in fg:
+                # so it is skipped as already copied next time
+                copylog.add(f, None, os.path.join(copyplan.destpath, duplicates[f]))
+            logger.debug("Already in the library: {}".format(fg.base_path))
+            return False
+        if copyplan.dedup == "link" and duplicates:
+            fg.duplicates = duplicates
+
+    index = index or DestIndex(copyplan.destpath)
+    # picked once per folder, so that copies made while still planning
+    # (copy_pipelined()) don't move the alternate of the later groups
+    if fg.dest_subfolder not in copyplan.alts:
+        copyplan.alts[fg.dest_subfolder] = index.alt_folder(fg.dest_subfolder)
+    fg.dest_subfolder = sys.intern(fg.dest_subfolder) # shared by every picture taken that day
+    fg.dest_subfolderalt = copyplan.alts[fg.dest_subfolder]
+    fg.total_bytes = total_bytes
 
     logger.debug("Planning to copy: {}".format(fg.base_path))
     copyplan.add(fg)
+    return True
+
+
+def replaced_since_copied(copylog, fg):
+    """
+    The copy log only knows the paths that were copied, and a camera reuses
+    the same names after its card is formatted.  So with --dedup the copy is
+    checked:  the file it was copied to must have the same size and partial
+    digest (see fastcopy.partial_digest()) as the one on the card now.
+    Files whose copy was moved or deleted since, or whose destination wasn't
+    logged, are taken to be the same.
+    :returns: True if a file in the group is not the one that was copied
+    """
+    for f in fg:
+        dest = copylog.copied_to(f)
+        if dest is None:
+            continue
+        try:
+            if os.path.getsize(dest) != fg.stat(f).st_size:
+                return True
+            if fastcopy.partial_digest(dest) != fastcopy.partial_digest(f):
+                return True
+        except OSError:
+            continue
+    return False
+
 
+def find_duplicates(library, fg):
+    """
+    Looks for the files of a group in the library (--dedup), under any name.
+    :param library: LibraryIndex of the destination
+    :returns: dictionary of file -> path of the same data, relative to the
+        library, for the files that are in it
+    """
+    duplicates = {}
+    for f in fg:
+        try:
+            found = library.find_duplicate(f, fg.stat(f).st_size)
+        except OSError as ex:
+            logger.debug("Could not check {} for duplicates: {}".format(f, ex))
+            continue
+        if found is not None:
+            logger.debug("{} is already in the library as {}".format(f, found))
+            duplicates[f] = found
+    return duplicates
 
 
-def try_copy(metrics, copyplan, copylog, fg):
+def schedule_all(metrics, copyplan, copylog, groups, jobs = 1, cache = None, index = None, on_planned = None):
     """
-    Copies all files for a picture, ensuring they will end up in the same place.
+    Calls schedule_copy() on every group, in order.
+
+    With more than one job, read_group_info() runs ahead of schedule_copy() on a
+    pool of threads, so several files are read from the card at once.  The
+    results are still consumed in the original order, so the plan (and the
+    --number and lookback behavior) is the same as scheduling them serially.
+    :param groups: iterable of FileGroup objects
+    :param jobs: number of threads used to read EXIF metadata
+    :param cache: optional MetadataCache
+    :param index: DestIndex of copyplan.destpath (a new one if not given)
+    :param on_planned: optional function called with each group as soon as
+        it is added to the plan
     """
-    destfolder = os.path.join(copyplan.destpath, fg.dest_subfolder)
-    if not os.path.isdir(destfolder):
-        os.makedirs(destfolder)
+    index = index or DestIndex(copyplan.destpath)
+
+    def schedule(fg, info = None):
+        if schedule_copy(metrics, copyplan, copylog, fg, info, cache, index) and on_planned is not None:
+            on_planned(fg)
+
+    if jobs <= 1:
+        for fg in groups:
+            schedule(fg)
+        return
+
+    def at_max():
+        return copyplan.maxpics and len(copyplan.groups_to_copy) >= copyplan.maxpics
 
+    window = jobs * 4 # how far ahead of the scheduler we are allowed to read
+    pending = collections.deque()
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        for fg in groups:
+            info = None
+            if not at_max() and (copyplan.force or not copylog.already_copied(*fg)):
+                info = pool.submit(read_group_info, fg, cache, metrics)
+            pending.append((fg, info))
+            if len(pending) >= window:
+                schedule(*pending.popleft())
+        while pending:
+            schedule(*pending.popleft())
+    finally:
+        # anything still queued was skipped because of --number
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+MTIME_SLACK_DAYS = 1 # cards store local times, which may be read in another time zone
+
+def plan_newest_first(metrics, copyplan, copylog, groups, jobs = 1, cache = None, index = None, on_planned = None):
+    """
+    Like schedule_all(), but visits the groups newest first, using the file
+    modification times (and the DCF numbers for pictures taken in the same
+    second) as a cheap guess of the EXIF date, so it can stop reading EXIF
+    metadata early:  once --number pictures are planned, or once the files
+    are older than the lookback (with a day of slack), since everything
+    after them is older too.  Pictures near the boundary are still checked
+    with their EXIF date.
+
+    With --number this plans the newest pictures, instead of the first ones
+    on the card.  The plan is put back in card order, so they are copied the
+    same way schedule_all() would have copied them.  Groups passed to
+    on_planned (copy_pipelined()) are still copied newest first.
+    """
+    groups = list(groups) # listing the card is cheap compared to reading EXIF
+    position = { fg.base_path: i for i, fg in enumerate(groups) }
+    groups.sort(key=lambda fg: (fg.mtime(), fg.dcf_number()), reverse=True)
+    oldest = copyplan.cutoff() - datetime.timedelta(days=MTIME_SLACK_DAYS)
+
+    def visit():
+        for i, fg in enumerate(groups):
+            if copyplan.maxpics and len(copyplan.groups_to_copy) >= copyplan.maxpics:
+                return
+            if datetime.date.fromtimestamp(fg.mtime()) < oldest:
+                logger.debug("Everything from {} on is too old to copy".format(fg.base_path))
+                for rest in groups[i:]:
+                    if (not copyplan.force) and copylog.already_copied(*rest):
+                        metrics.inc_already_copied(list(rest))
+                    else:
+                        metrics.inc_too_old(list(rest))
+                return
+            yield fg
+
+    schedule_all(metrics, copyplan, copylog, visit(), jobs, cache, index, on_planned)
+    copyplan.groups_to_copy.sort(key=lambda fg: position[fg.base_path])
+
+
+def choose_subfolder(fg, index, alt, compare = False):
+    """
+    Picks the folder a group of files is copied to in one destination.
+    :param alt: the alternate folder to try first if the files don't fit in
+        fg.dest_subfolder
+    :param compare: files of the right size must have the same partial
+        digest too (--dedup), since a formatted card reuses the names, and
+        some raw files are always the same size
+    """
     # cases:
     # - all files exist with correct size => use dest folder
     # - all files exist with correct size OR are completely missing => use dest folder and skip
     #   (should be a superset of anything involving the copylog)
     # - anything else? => copy everything to an alternate folder
-    use_alt_folder = False
-    for f in fg:
-        fdest = os.path.join(destfolder, os.path.basename(f))
-        if os.path.isdir(fdest):
-            use_alt_folder = True # path is a dir somehow
-        elif os.path.isfile(fdest):
-            if os.path.getsize(f) != os.path.getsize(fdest):
-                use_alt_folder = True # file exists with wrong size
-
-    if use_alt_folder:
-        destfolder = os.path.join(copyplan.destpath, fg.dest_subfolderalt)
-        os.makedirs(destfolder)
-        metrics.alt_folders.append(destfolder)
-        
+    def fits(subfolder):
+        for f in fg:
+            size = index.size(subfolder, os.path.basename(f))
+            if size is not None and size != fg.stat(f).st_size:
+                return False # file exists with wrong size, or path is a dir somehow
+            if size is not None and compare:
+                fdest = os.path.join(index.destpath, subfolder, os.path.basename(f))
+                if fastcopy.partial_digest(fdest) != fastcopy.partial_digest(f):
+                    return False
+        return True
+
+    if fits(fg.dest_subfolder):
+        return fg.dest_subfolder
+    # other groups from the same folder may already be using the alternate,
+    # and if a third picture with the same name is using it, try the ones
+    # after it (a folder that doesn't exist yet always fits)
+    start = int(alt.rsplit("_", 1)[1])
+    return diskutil.alt_folder(fg.dest_subfolder, start=start, exists=lambda a: not fits(a))
+
+
+def try_copy(metrics, copyplan, copylog, fg, journal = None, index = None, throttle = None):
+    """
+    Copies all files for a picture, ensuring they will end up in the same place.
+    With copyplan.backups, each file is read once and written to every
+    destination that doesn't have it yet.  With copyplan.clone, destinations
+    on the same filesystem as the file get a clone of it instead, and any
+    that can't be cloned are copied.  Files that --dedup found in the
+    library (fg.duplicates) are hardlinked to the copy that is already there.
+    Files written to copyplan.destpath are added to copyplan.library.
+    :param journal: CopyJournal to stage the copies in, if copyplan.journal
+    :param index: DestIndex of copyplan.destpath (a new one if not given)
+    :param throttle: fastcopy.Throttle for the limits of copyplan, if any
+    """
+    index = index or DestIndex(copyplan.destpath)
+    waited = throttle.waited() if throttle is not None else 0.0
+
+    # (destpath, DestIndex, Metrics, backup or not, subfolder) for each destination
+    targets = [(copyplan.destpath, index, metrics, False, fg.dest_subfolderalt)]
+    targets += [(b.destpath, b.index, b.metrics, True, b.alt_folder(fg.dest_subfolder)) for b in copyplan.backups]
+    for i, (destpath, tindex, tmetrics, backup, alt) in enumerate(targets):
+        subfolder = choose_subfolder(fg, tindex, alt, copyplan.dedup is not None)
+        if subfolder != fg.dest_subfolder:
+            tmetrics.add_alt_folder(os.path.join(destpath, subfolder))
+        tindex.makedirs(subfolder)
+        targets[i] = (destpath, tindex, tmetrics, backup, subfolder)
 
     for f in fg:
-        fdest = os.path.join(destfolder, os.path.basename(f))
-        if os.path.isfile(fdest):
-            if os.path.getsize(f) == os.path.getsize(fdest):
+        name = os.path.basename(f)
+        st = fg.stat(f)
+        todo = []
+        for destpath, tindex, tmetrics, backup, subfolder in targets:
+            fdest = os.path.join(destpath, subfolder, name)
+            if tindex.size(subfolder, name) is not None:
                 logger.debug("skipping {} b/c it already exists with the correct size".format(fdest))
-                metrics.file_existed.append(f)
+                tmetrics.add_file_existed(f)
+                tmetrics.add_skipped_bytes(st.st_size)
             else:
-                raise Exception("logic error copying files") # this should not happen
-        else:
-            logger.debug("copying {} to {}".format(f, fdest))
+                target = fdest if journal is None else CopyJournal.temp_path(fdest)
+                todo.append((fdest, target, tindex, tmetrics, backup, subfolder))
+        if not todo:
+            continue
+
+        copy_mode = copyplan.copy_backend == "copy"
+        cloned = set()
+        if fg.duplicates and f in fg.duplicates:
+            original = os.path.join(copyplan.destpath, fg.duplicates[f])
+            for t in todo:
+                if t[4]:
+                    continue # backups get a copy
+                try:
+                    os.link(original, t[1])
+                    cloned.add(t[1])
+                    logger.debug("linked {} to {}".format(original, t[0]))
+                except OSError as ex:
+                    logger.debug("could not link {} to {}, copying it instead: {}".format(original, t[0], ex))
+        if copyplan.clone:
+            for t in todo:
+                if t[2].device() != st.st_dev or t[1] in cloned:
+                    continue
+                try:
+                    fastcopy.clone(f, t[1], copyplan.clone)
+                    if copy_mode and copyplan.clone == "reflink":
+                        shutil.copymode(f, t[1])
+                    cloned.add(t[1])
+                    logger.debug("cloned {} to {}".format(f, t[0]))
+                except OSError as ex:
+                    logger.debug("could not clone {} to {}, copying it instead: {}".format(f, t[0], ex))
+        tocopy = [t for t in todo if t[1] not in cloned]
+
+        if tocopy:
+            logger.debug("copying {} to {}".format(f, ", ".join(t[0] for t in tocopy)))
+        errors = {}
+        digest = None
+        start = time.perf_counter()
+        try:
+            if len(tocopy) == 1:
+                digest = fastcopy.copy(f, tocopy[0][1], copyplan.copy_backend, copyplan.hash_algorithm, throttle)
+            elif tocopy:
+                digest, errors = fastcopy.copy_fanout(f, [t[1] for t in tocopy], copyplan.hash_algorithm, copy_mode, throttle)
+        except IOError as ex:
+            errors = { t[1]: ex for t in tocopy }
+        elapsed = time.perf_counter() - start
+        if digest is None and copyplan.hash_algorithm and cloned:
+            # nothing was read while copying, so the clones are hashed instead
+            try:
+                digest = fastcopy.file_digest(f, copyplan.hash_algorithm, throttle=throttle)
+            except IOError as ex:
+                errors.update((target, ex) for target in cloned)
+
+        # the source is only logged as copied once every destination has it,
+        # otherwise the next run would skip it and a failed backup would
+        # never get it
+        staged, written, complete = [], False, True
+        for fdest, target, tindex, tmetrics, backup, subfolder in todo:
             try:
-                shutil.copy(f, fdest)
-                copylog.add(f)
-                metrics.inc_copied()
+                if target in errors:
+                    raise errors[target]
+                if target in cloned:
+                    tmetrics.record_clone(st.st_size)
+                else:
+                    tmetrics.record_copy(st.st_size, elapsed, st.st_dev)
+                if copyplan.verify_copies:
+                    if fastcopy.file_digest(target, copyplan.hash_algorithm, uncached=True, throttle=throttle) != digest:
+                        os.remove(target) # otherwise the next run would skip it for having the right size
+                        raise IOError("{} does not match {} after copying".format(target, f))
+                    tmetrics.inc_verified()
+                if journal is not None:
+                    staged.append((f, target, fdest, digest, tmetrics if backup else None))
+                else:
+                    written = True
+                    tmetrics.inc_copied()
+                    if copyplan.library is not None and not backup:
+                        copyplan.library.add(fdest)
+                tindex.add(subfolder, name, st.st_size)
             except IOError:
-                metrics.failed.append(fdest)
+                complete = False
+                tmetrics.add_failed(fdest)
                 traceback.print_exc()
+        log = (digest, os.path.join(targets[0][0], targets[0][4], name)) if complete else None
+        if staged:
+            journal.stage_all(staged, log)
+        elif written and log is not None:
+            copylog.add(f, *log)
+    if throttle is not None:
+        metrics.add_throttle_wait(throttle.waited() - waited)
+
 
+_group_locks = {}
+_group_locks_lock = threading.Lock()
 
-def copy_pictures(logger, metrics, copyplan, logsfolder, picfiles, autoyes):
+def group_lock(destpath, key):
     """
-    This is the main method.  Scans the pictures to figure out which ones to
-    copy, and copies them.
+    :returns: the lock for the groups of pictures with this key (destination
+        subfolder, lowercase basename) in destpath, shared by all imports
+        running in this process
+    """
+    with _group_locks_lock:
+        return _group_locks.setdefault((os.path.abspath(destpath),) + tuple(key), threading.Lock())
+
+
+_throttles = {}
+_throttles_lock = threading.Lock()
+
+def shared_throttle(copyplan):
+    """
+    :returns: the fastcopy.Throttle for the limits of copyplan, or None if it
+        has none.  Imports running in this process at the same time with
+        the same limits (--watch) share it, so the limits are for all of
+        them together.
+    """
+    key = (copyplan.max_read_mbps, copyplan.max_write_mbps, copyplan.idle_io, copyplan.drop_cache)
+    if not any(key):
+        return None
+    with _throttles_lock:
+        if key not in _throttles:
+            _throttles[key] = fastcopy.Throttle(*key)
+        return _throttles[key]
+
+
+@contextlib.contextmanager
+def dest_indexes(copyplan):
+    """
+    Opens the shared DestIndex of the main destination, which it yields, and
+    of each backup
+    """
+    with contextlib.ExitStack() as stack:
+        index = stack.enter_context(DestIndex.shared(copyplan.destpath))
+        for b in copyplan.backups:
+            b.index = stack.enter_context(DestIndex.shared(b.destpath))
+        yield index
+
+
+@contextlib.contextmanager
+def library_index(copyplan, metrics):
+    """
+    Opens the LibraryIndex of the main destination as copyplan.library, if
+    there is a --dedup or it already has one (from --verify), so that the
+    files copied are added to it.  With --dedup, files that got into the
+    library some other way are indexed first (without hashing them), from
+    the folders that changed since the last import, or all of them with
+    --force.
+    """
+    if not (copyplan.dedup or LibraryIndex.exists(copyplan.destpath)):
+        yield None
+        return
+    with LibraryIndex.shared(copyplan.destpath) as library:
+        if copyplan.dedup:
+            with metrics.phase("index"):
+                added = library.scan(full=copyplan.force)
+            if added:
+                logger.info("Indexed {} files in {}".format(added, copyplan.destpath))
+        copyplan.library = library
+        try:
+            yield library
+        finally:
+            copyplan.library = None
+
+
+PREFETCH_BYTES = 16 * 1024 * 1024 # read ahead from each file of the next group, see copy_all()
+
+def lookahead(groups):
+    """
+    Yields (group, the group after it, or None for the last one)
+    """
+    it = iter(groups)
+    group = next(it, None)
+    while group is not None:
+        following = next(it, None)
+        yield group, following
+        group = following
+
+
+def physical_order(groups):
+    """
+    Sorts the groups of a plan in the order their data is on the card, so
+    that it is read from start to end instead of jumping around, which slow
+    cards and disks (and their readahead) are much better at.  Each group is
+    placed by the file of it that comes first (see fastcopy.first_extent()).
+    When the filesystem can't tell where any of them are (no FIEMAP, or not
+    Linux), the plan order is kept:  there is nothing better to go by, the
+    inode numbers of FAT and exFAT files only reflect the order they were
+    looked up in.  Groups it can't tell for come after the others.
+
+    Folders keep their order in the plan, so pictures with the same name in
+    different DCF folders are still copied in plan order, which decides
+    which of them goes to an alternate folder (see copy_all()).
+    :returns: a new list
+
+    >>> groups = []
+    >>> for path in ["/card/DCIM/101NIKON/DSC_0002.JPG", "/card/DCIM/100NIKON/DSC_0001.JPG"]:
+    ...     groups.append(FileGroup())
+    ...     groups[-1].append(path, FileStat(1000, 0, 1))
+    >>> [fg.base_path for fg in physical_order(groups)] # not on a disk at all
+    ['/card/DCIM/101NIKON/DSC_0002', '/card/DCIM/100NIKON/DSC_0001']
+    """
+    folders = {}
+    for fg in groups:
+        folders.setdefault(fg.folder, len(folders))
+
+    def position(fg):
+        offsets = [offset for offset in map(fastcopy.first_extent, fg) if offset is not None]
+        return min(offsets) if offsets else None
+
+    positions = [position(fg) for fg in groups]
+    if all(p is None for p in positions):
+        return list(groups)
+    order = sorted(range(len(groups)), key=lambda i: (folders[groups[i].folder], positions[i] is None, positions[i] or 0, i))
+    return [groups[i] for i in order]
+
+
+def copy_all(metrics, copyplan, copylog, jobs = 1, skip_copied = False, progress = None, shared_dest = False, index = None, groups = None):
+    """
+    Calls try_copy() on every group in the plan, copying up to `jobs` groups at
+    the same time.
+
+    Each group is copied by a single worker, so its files still end up in the
+    same folder.  Groups that could collide with each other (same destination
+    subfolder and same filename, e.g. DSC_0001 from two DCF folders) are copied
+    one after the other, in plan order, so they pick the same folders (and
+    alternate folders) they would have picked in a serial copy.
+    :param jobs: number of groups to copy at once
+    :param skip_copied: skip groups that the copy log says were already copied
+        (when resuming a plan)
+    :param progress: optional Progress to report the copy with
+    :param shared_dest: other imports in this process may be copying to the
+        same destination at the same time (--watch)
+    :param index: DestIndex of copyplan.destpath (a new one if not given)
+    :param groups: iterable of the groups to copy, if they are not all in
+        copyplan.groups_to_copy yet (copy_pipelined()).  Groups are copied
+        as they come, with at most jobs * 4 of them waiting.
+
+    Unless there are bandwidth limits, the start of the files of the next
+    group in the plan is prefetched when a group starts copying, so the card
+    is read while the copy is written.  Groups that are still being planned
+    are not waited for to do that.
+    """
+    journal = CopyJournal(metrics, copylog, library=copyplan.library) if copyplan.journal else None
+    throttle = shared_throttle(copyplan)
+    index = index or DestIndex(copyplan.destpath)
+    if groups is None and throttle is None:
+        groups = lookahead(copyplan.groups_to_copy)
+    else:
+        groups = ((group, None) for group in (copyplan.groups_to_copy if groups is None else groups))
+
+    def copy_group(group, key, first, following = None):
+        if shared_dest:
+            # another card being copied at the same time may have the same
+            # pictures (e.g. the backup card of a camera with two slots), so
+            # it has to see what this group copied under the real names
+            with group_lock(copyplan.destpath, key):
+                try:
+                    copy_one(group, first, following)
+                finally:
+                    if journal is not None:
+                        journal.commit()
+        else:
+            copy_one(group, first, following)
+
+    def copy_one(group, first, following):
+        if following is not None:
+            for f in following:
+                fastcopy.prefetch(f, PREFETCH_BYTES)
+        if skip_copied and copylog.already_copied(*group):
+            metrics.inc_already_copied(list(group))
+            metrics.add_skipped_bytes(group.total_bytes)
+            metrics.inc_groups_done(len(group.files))
+            return
+        if journal is not None and not first:
+            # the next group has to see what this one copied
+            journal.commit()
+        try:
+            try_copy(metrics, copyplan, copylog, group, journal, index, throttle)
+        finally:
+            metrics.inc_groups_done(len(group.files))
+
+    def key_of(group):
+        return (group.dest_subfolder, os.path.basename(group.base_path).lower())
+
+    copied_before = metrics.bytes_copied
+    try:
+        with metrics.phase("copy"), (progress.reporting(copyplan) if progress else contextlib.nullcontext()):
+            try:
+                if jobs <= 1:
+                    seen = set()
+                    for group, following in groups:
+                        key = key_of(group)
+                        copy_group(group, key, key not in seen, following)
+                        seen.add(key)
+                else:
+                    last = {} # key -> future of the last group with that key
+                    window = threading.BoundedSemaphore(jobs * 4)
+                    futures = []
+
+                    def copy_after(group, key, previous, following):
+                        try:
+                            if previous is not None:
+                                # it was submitted first, so it is already running
+                                concurrent.futures.wait([previous])
+                            copy_group(group, key, previous is None, following)
+                        finally:
+                            window.release()
+
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+                        for group, following in groups:
+                            key = key_of(group)
+                            window.acquire()
+                            f = pool.submit(copy_after, group, key, last.get(key), following)
+                            last[key] = f
+                            futures.append(f)
+                        for f in futures:
+                            f.result()
+            finally:
+                if journal is not None:
+                    journal.commit()
+    finally:
+        metrics.add_phase_bytes("copy", metrics.bytes_copied - copied_before)
+
+
+PIPELINE_QUEUE_SIZE = 64 # planned groups waiting to be copied, see copy_pipelined()
+
+def copy_pipelined(logger, metrics, copyplan, copylog, plan, copy_jobs = 1, progress = None, shared_dest = False, index = None):
     """
-    metrics.total_seen = len(picfiles)
+    Copies the pictures while they are still being planned (--pipeline):
+    the planner runs on its own thread, reading the card as the walker finds
+    the files, and every group it plans goes straight to copy_all() through
+    a bounded queue.  When the copy falls behind the planner waits, so only
+    PIPELINE_QUEUE_SIZE planned groups are ever waiting.
+
+    There is nothing to confirm, so the free space can't be checked against
+    the whole plan first.  Instead the planned bytes are checked as they grow,
+    and a warning is logged the first time they are more than was available
+    at a destination.
+    :param plan: function that runs the planner (schedule_all() or
+        plan_newest_first()), calling its argument with each planned group
+    """
+    done = object()
+    planned = queue.Queue(PIPELINE_QUEUE_SIZE)
+    stop = threading.Event()
+    failure = []
+
+    destinations = [(copyplan.destpath, copyplan.start_disk_avail)]
+    destinations += [(b.destpath, b.metrics.start_disk_avail) for b in copyplan.backups]
+    warned = set()
 
-    def name(path):
-        return str(pathlib.Path(path).with_suffix(""))
+    def put(item):
+        while not stop.is_set():
+            try:
+                planned.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def on_planned(fg):
+        for destpath, avail in destinations:
+            if avail is not None and copyplan.bytes_to_copy > avail and destpath not in warned:
+                warned.add(destpath)
+                logger.warning("Warning!  Planned {} so far, more than the {} available at {}".format(
+                    diskutil.hr(copyplan.bytes_to_copy), diskutil.hr(avail), destpath))
+        if not put(fg):
+            raise concurrent.futures.CancelledError()
+
+    def planner():
+        try:
+            plan(on_planned)
+        except BaseException as ex:
+            failure.append(ex)
+        finally:
+            copyplan.planning = False
+            put(done)
+
+    def stream():
+        while True:
+            fg = planned.get()
+            if fg is done:
+                return
+            yield fg
+
+    copyplan.planning = True
+    thread = threading.Thread(target=planner, name="planner", daemon=True)
+    thread.start()
+    try:
+        copy_all(metrics, copyplan, copylog, copy_jobs, progress=progress, shared_dest=shared_dest, index=index, groups=stream())
+    finally:
+        stop.set()
+        thread.join()
+    if failure:
+        raise failure[0]
 
-    groups = collections.defaultdict(FileGroup)
-    for p in picfiles:
-        groups[FileGroup.basepath(p)].append(p)
+
+def resume_copy(logger, metrics, planfile, logsfolder, copy_jobs = 1, progress = None):
+    """
+    Finishes copying a plan that was saved by an import that was interrupted,
+    without scanning the card again.
+    """
+    copyplan = CopyPlan.load(planfile)
+    metrics.start_disk_avail = diskutil.avail_space(copyplan.destpath)
+
+    logger.info("Resuming copy of {} pictures to {}".format(len(copyplan.groups_to_copy), copyplan.destpath))
+    for b in copyplan.backups:
+        b.metrics.start_disk_avail = diskutil.avail_space(b.destpath)
+    with CopyLog.load(logsfolder) as copylog, dest_indexes(copyplan) as index, library_index(copyplan, metrics):
+        # before anything in those folders is listed
+        subfolders = set(group.dest_subfolder for group in copyplan.groups_to_copy)
+        for destpath, dindex in [(copyplan.destpath, index)] + [(b.destpath, b.index) for b in copyplan.backups]:
+            for subfolder in sorted(subfolders):
+                for folder in [subfolder] + dindex.alt_folders(subfolder):
+                    CopyJournal.cleanup(os.path.join(destpath, folder))
+        copy_all(metrics, copyplan, copylog, copy_jobs, skip_copied=True, progress=progress, index=index)
+    for b in copyplan.backups:
+        b.metrics.end_disk_avail = diskutil.avail_space(b.destpath)
+    os.remove(planfile)
+    return copyplan
+
+
+def scan_card(logger, copyplan, logsfolder, path):
+    """
+    Walks a card, leaving out the DCF folders that haven't changed since it
+    was last imported (see CardFingerprint).  Everything outside them is
+    walked every time.
+    :returns: tuple of (CardFingerprint, iterable of FileGroups), or of
+        (CardFingerprint, None) if nothing on the card has changed
+
+    >>> import logging, tempfile
+    >>> card, logs = tempfile.mkdtemp(), tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(card, "DCIM", "100NIKON"))
+    >>> open(os.path.join(card, "DCIM", "100NIKON", "DSC_0001.JPG"), "w").close()
+    >>> copyplan, logger = CopyPlan(3), logging.getLogger("importpics.scan")
+    >>> fp, groups = scan_card(logger, copyplan, logs, card)
+    >>> [fg.base_path[len(card):] for fg in groups]
+    ['/DCIM/100NIKON/DSC_0001']
+    >>> db = CopyLog.open_db(logs)
+    >>> fp.save(db, copyplan.cutoff())
+    >>> db.close()
+    >>> scan_card(logger, copyplan, logs, card)[1] is None
+    True
+    >>> os.makedirs(os.path.join(card, "MISC"))
+    >>> open(os.path.join(card, "MISC", "IMG_0001.JPG"), "w").close()
+    >>> [fg.base_path[len(card):] for fg in scan_card(logger, copyplan, logs, card)[1]]
+    ['/MISC/IMG_0001']
+    """
+    card = CardFingerprint(path)
+    dbfile = os.path.join(os.path.expanduser(logsfolder), "copylog.db")
+    if card.folders and not copyplan.force and os.path.isfile(dbfile):
+        db = CopyLog.open_db(os.path.dirname(dbfile))
+        try:
+            card.unchanged(db, copyplan.cutoff())
+        finally:
+            db.close()
+        logger.debug("Card {} has fingerprint {}".format(card.card_id, card.digest()))
+    skip = set(os.path.join(path, "DCIM", folder) for folder in card.skipped)
+    if card.skipped and card.skipped == set(card.folders):
+        # pictures outside of DCIM aren't in the fingerprint
+        groups = list(walk_groups(path, skip=skip))
+        return card, groups or None
+    if card.skipped:
+        logger.info("Skipping {} of {} folders, unchanged since the card was last imported".format(
+            len(card.skipped), len(card.folders)))
+    return card, walk_groups(path, skip=skip)
+
+
+def remember_card(card, copyplan, metrics, logsfolder):
+    """
+    Saves the fingerprint of a card after importing it, if everything on it
+    that could be copied was copied.  Otherwise the card is forgotten, so
+    that the next import walks all of it.
+    """
+    complete = not metrics.failed and not any(b.metrics.failed for b in copyplan.backups)
+    if copyplan.maxpics and len(copyplan.groups_to_copy) >= copyplan.maxpics:
+        complete = False
+    if card.folders:
+        db = CopyLog.open_db(os.path.expanduser(logsfolder))
+        try:
+            if complete:
+                card.save(db, copyplan.cutoff())
+            else:
+                card.forget(db)
+        finally:
+            db.close()
+
+
+def copy_pictures(logger, metrics, copyplan, logsfolder, filegroups, autoyes, jobs = 1, cachefolder = None, copy_jobs = 1, planfile = None, progress = None, shared_dest = False):
+    """
+    This is the main method.  Scans the pictures to figure out which ones to
+    copy, and copies them.
+    :param filegroups: iterable of FileGroups, e.g. from walk_groups()
+    :param planfile: where to save the plan while copying with copyplan.journal,
+        so that resume_copy() can finish it if the import is interrupted
+    :param progress: optional Progress to report the copy with
+    :param shared_dest: other imports in this process may be copying to the
+        same destination at the same time (--watch)
+
+    With copyplan.pipelined and autoyes, the copy starts as soon as the first
+    picture is planned (see copy_pipelined()).  No plan is saved then, since
+    it is never complete before copying;  an interrupted --journal import is
+    finished by importing again.
+    """
+    metrics.total_seen = 0
+
+    def count(filegroups):
+        # time spent waiting on the card walker is the "walk" phase (it is part of "plan")
+        it = iter(filegroups)
+        while True:
+            with metrics.phase("walk"):
+                fg = next(it, None)
+            if fg is None:
+                return
+            metrics.total_seen += len(fg.files)
+            yield fg
+    groups = count(filegroups)
+
+    pipelined = copyplan.pipelined and autoyes
+    planfile = None if pipelined else planfile
+    for b in copyplan.backups:
+        b.metrics.start_disk_avail = diskutil.avail_space(b.destpath)
 
     logger.info("Scanning for files to copy...")
-    with CopyLog.load(logsfolder) as copylog:
+    with CopyLog.load(logsfolder) as copylog, dest_indexes(copyplan) as index, library_index(copyplan, metrics), contextlib.ExitStack() as stack:
+        cache = None if cachefolder is None else stack.enter_context(MetadataCache.load(cachefolder))
+
         # see which ones we can copy
-        for g in groups.keys():
-            schedule_copy(metrics, copyplan, copylog, groups[g])
+        def plan(on_planned = None):
+            with metrics.phase("plan"):
+                planner = plan_newest_first if copyplan.newest_first else schedule_all
+                planner(metrics, copyplan, copylog, groups, jobs, cache, index, on_planned)
+
+        if pipelined:
+            logger.info("Copying pictures as they are found")
+            copy_pipelined(logger, metrics, copyplan, copylog, plan, copy_jobs, progress, shared_dest, index)
+        else:
+            plan()
+            with metrics.phase("confirm"):
+                # TODO - check against filesystem avail
+                msg = "About to copy {} pictures at {}.  Continue?".format(
+                    len(copyplan.groups_to_copy),
+                    diskutil.human_readable(copyplan.bytes_to_copy),
+                )
+                confirmOrDie(msg, autoyes)
+
+                destinations = [(copyplan.destpath, copyplan.start_disk_avail)]
+                destinations += [(b.destpath, b.metrics.start_disk_avail) for b in copyplan.backups]
+                for destpath, avail in destinations:
+                    if copyplan.bytes_to_copy > avail:
+                        msg = "Warning!  {} is more than the {} available at {}.  Are you sure you want to continue?"
+                        msg = msg.format(
+                            diskutil.hr(copyplan.bytes_to_copy),
+                            diskutil.hr(avail),
+                            destpath,
+                        )
+                        confirmOrDie(msg, autoyes)
+
+            if copyplan.copy_order == "physical":
+                with metrics.phase("order"):
+                    copyplan.groups_to_copy = physical_order(copyplan.groups_to_copy)
+            logger.info("Copying {} pictures".format(len(copyplan.groups_to_copy)))
+            if copyplan.journal and planfile:
+                copyplan.save(planfile)
+            copy_all(metrics, copyplan, copylog, copy_jobs, progress=progress, shared_dest=shared_dest, index=index)
+    for b in copyplan.backups:
+        b.metrics.total_seen = metrics.total_seen
+        b.metrics.end_disk_avail = diskutil.avail_space(b.destpath)
+    if copyplan.journal and planfile:
+        os.remove(planfile)
+
+
+WATCH_PREFIXES = ["/media", "/run/media", "/mnt"]
+
+
+class VolumeLogger(logging.LoggerAdapter):
+    """
+    Prefixes messages with the volume they are about, when several cards are
+    imported at once
+    """
+    def process(self, msg, kwargs):
+        return "[{}] {}".format(self.extra["volume"], msg), kwargs
 
-        # TODO - check against filesystem avail
-        msg = "About to copy {} pictures at {}.  Continue?".format(
-            len(copyplan.groups_to_copy),
-            diskutil.human_readable(copyplan.bytes_to_copy),
-        )
-        confirmOrDie(msg, autoyes)
 
-        if copyplan.bytes_to_copy > copyplan.start_disk_avail:
-            msg = "Warning!  {} is more than the {} available at {}.  Are you sure you want to continue?"
-            msg = msg.format(
-                diskutil.hr(copyplan.bytes_to_copy),
-                diskutil.hr(copyplan.start_disk_avail),
-                copyplan.destpath,
-            )
-            confirmOrDie(msg, autoyes)
+def is_card(mount, prefixes):
+    """
+    True if the filesystem was mounted under one of the prefixes and looks
+    like a camera card (it has a DCIM folder)
+    """
+    under = any(mount.mountpoint.startswith(p.rstrip("/") + "/") for p in prefixes)
+    return under and os.path.isdir(os.path.join(mount.mountpoint, "DCIM"))
+
+
+def import_volume(logger, volume, make_copyplan, logsfolder, jobs = 1, cachefolder = None, copy_jobs = 1):
+    """
+    Imports everything on a volume without asking any questions, like --yes.
+    :param make_copyplan: function returning a new CopyPlan with destpath set
+    :returns: the Metrics of the import
+    """
+    metrics = Metrics()
+    copyplan = make_copyplan()
+    card, groups = scan_card(logger, copyplan, logsfolder, volume)
+    if groups is None:
+        logger.info("Nothing new since the card was last imported")
+        return metrics
+    copyplan.start_disk_avail = metrics.start_disk_avail = diskutil.avail_space(copyplan.destpath)
+    copy_pictures(logger, metrics, copyplan, logsfolder, groups, True, jobs, cachefolder, copy_jobs, shared_dest=True)
+    metrics.end_disk_avail = diskutil.avail_space(copyplan.destpath)
+    remember_card(card, copyplan, metrics, logsfolder)
+    for b in copyplan.backups:
+        logger.info("Copied to {}:\n{}".format(b.destpath, b.metrics))
+    return metrics
+
+
+def watch(logger, make_copyplan, logsfolder, prefixes = WATCH_PREFIXES, jobs = 1, cachefolder = None, copy_jobs = 1,
+        max_cards = 4, interval = 2.0, mountinfo = diskutil.MOUNTINFO, stop = None):
+    """
+    Runs until stopped, importing every camera card that gets mounted under
+    one of the prefixes, up to max_cards at the same time, each with its own
+    Metrics.  Volumes that are already mounted when it starts are left alone.
+    :param stop: optional threading.Event to stop watching
+    :returns: list of (mountpoint, Metrics) of the finished imports
+    """
+    stop = stop or threading.Event()
+    watcher = diskutil.MountWatcher(mountinfo)
+    known = set(m.mount_id for m in watcher.mounts())
+    running = {}
+    finished = []
+
+    def reap(wait = False):
+        done = list(running) if wait else [f for f in running if f.done()]
+        for f in done:
+            mountpoint = running.pop(f)
+            try:
+                metrics = f.result()
+                logger.info("Finished importing {}:\n{}".format(mountpoint, metrics))
+                finished.append((mountpoint, metrics))
+            except (Exception, SystemExit):
+                logger.exception("Importing {} failed".format(mountpoint))
+
+    logger.info("Watching for cards mounted under {}".format(", ".join(prefixes)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_cards) as pool:
+        try:
+            while not stop.is_set():
+                mounts = watcher.mounts()
+                for m in mounts:
+                    if m.mount_id in known:
+                        continue
+                    known.add(m.mount_id)
+                    if is_card(m, prefixes):
+                        logger.info("Importing {} from {}".format(m.mountpoint, m.source))
+                        cardlogger = VolumeLogger(logger, {"volume": os.path.basename(m.mountpoint)})
+                        f = pool.submit(import_volume, cardlogger, m.mountpoint, make_copyplan, logsfolder, jobs, cachefolder, copy_jobs)
+                        running[f] = m.mountpoint
+                # mount ids are reused after an unmount
+                known &= set(m.mount_id for m in mounts)
+                reap()
+                watcher.wait(interval)
+        except KeyboardInterrupt:
+            logger.info("Stopping, waiting for {} imports to finish".format(len(running)))
+        finally:
+            watcher.close()
+            reap(wait=True)
+    return finished
+
+
+def verify_library(logger, metrics, destpath, logsfolder, jobs = 1, rehash = False, algorithm = None):
+    """
+    Checks every file in the library at destpath against the digest recorded
+    for it (--verify):  the one from the last time it was verified (see
+    library.LibraryIndex), or else the one taken while copying it (--hash).
+    Files that don't have one yet get one, so the first run builds the
+    index.  Files are hashed on `jobs` threads with fastcopy.mmap_digest().
+
+    Files with the same size and modification time as when they were last
+    hashed are not hashed again, unless `rehash`.  Files that didn't match
+    their digest are checked every time, until they do again.  The problems
+    found are recorded in metrics.mismatched, changed and missing.
+    :param algorithm: hash to use for files that don't have a digest yet
+
+    >>> import tempfile
+    >>> library, logs = tempfile.mkdtemp(), tempfile.mkdtemp()
+    >>> quiet = logging.getLogger("importpics.verify")
+    >>> quiet.disabled = True
+    >>> path = os.path.join(library, "DSC_0001.JPG")
+    >>> with open(path, "wb") as f:
+    ...     _ = f.write(b"abc")
+    >>> def verify(rehash = False):
+    ...     metrics = Metrics()
+    ...     verify_library(quiet, metrics, library, logs, rehash=rehash)
+    ...     return metrics.hashed, metrics.unchanged, [os.path.basename(p) for p in metrics.mismatched]
+    >>> verify()
+    (1, 0, [])
+    >>> st = os.stat(path)
+    >>> with open(path, "r+b") as f: # bit rot keeps the size and modification time
+    ...     _ = f.write(b"x")
+    >>> os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    >>> verify(), verify(rehash=True), verify()
+    ((0, 1, []), (1, 0, ['DSC_0001.JPG']), (1, 0, ['DSC_0001.JPG']))
+    >>> with open(path, "wb") as f: # restored from a backup
+    ...     _ = f.write(b"abc")
+    >>> verify(), verify()
+    ((1, 0, []), (0, 1, []))
+
+    The copy log has the absolute paths of the copies, so a relative path
+    to the library works too:
+    >>> with CopyLog.load(logs) as copylog:
+    ...     copylog.add("/card/DSC_0002.JPG", "blake2b:1234", os.path.join(library, "DSC_0002.JPG"))
+    >>> os.remove(os.path.join(library, ".importpics.db"))
+    >>> metrics = Metrics()
+    >>> verify_library(quiet, metrics, os.path.relpath(library), logs)
+    >>> [os.path.basename(p) for p in metrics.missing]
+    ['DSC_0002.JPG']
+    """
+    destpath = os.path.abspath(os.path.expanduser(destpath))
+    algorithm = algorithm or fastcopy.DEFAULT_HASH
+    metrics.hashed, metrics.unchanged = 0, 0
+    dbfile = os.path.join(os.path.expanduser(logsfolder), "copylog.db")
+    copylog = CopyLog.open_db(os.path.dirname(dbfile)) if os.path.isfile(dbfile) else None
+    seen = set()
+
+    def copied_digest(path):
+        if copylog is None:
+            return None
+        row = copylog.execute("SELECT digest FROM copied WHERE dest = ? AND digest IS NOT NULL", (path,)).fetchone()
+        return row[0] if row else None
+
+    def finish(relpath, st, expected, future):
+        path = os.path.join(destpath, relpath)
+        try:
+            digest = future.result()
+        except OSError as ex:
+            logger.warning("Could not read {}: {}".format(path, ex))
+            metrics.add_failed(path)
+            return
+        metrics.hashed += 1
+        metrics.add_phase_bytes("verify", st.st_size)
+        bad = expected is not None and digest != expected
+        if bad:
+            logger.warning("{} does not match its digest".format(path))
+            metrics.mismatched.append(path)
+            digest = expected # so it is reported again until it is fixed
+        index.put(relpath, st.st_size, st.st_mtime_ns, digest, bad=bad)
+        if metrics.hashed % 1000 == 0:
+            index.commit()
+
+    logger.info("Verifying {}".format(destpath))
+    try:
+        with LibraryIndex.load(destpath) as index, metrics.phase("verify"):
+            first = index.count(hashed=True) == 0
+            window = jobs * 4 # how far ahead of the checks the hashing may run
+            pending = collections.deque()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+                for relpath, st in walk_library(destpath):
+                    seen.add(relpath)
+                    path = os.path.join(destpath, relpath)
+                    row = index.get(relpath)
+                    if row is not None and index.is_bad(relpath):
+                        expected = row[2]
+                    elif row is not None and row[2] is None:
+                        # indexed by an import (--dedup), but never hashed
+                        expected = copied_digest(path)
+                    elif row is not None and row[0:2] == (st.st_size, st.st_mtime_ns):
+                        if not rehash:
+                            metrics.unchanged += 1
+                            continue
+                        expected = row[2]
+                    elif row is not None:
+                        logger.info("{} has changed since it was last verified".format(path))
+                        metrics.changed.append(path)
+                        expected = None
+                    else:
+                        expected = copied_digest(path)
+                    kind = expected.split(":", 1)[0] if expected else algorithm
+                    pending.append((relpath, st, expected, pool.submit(fastcopy.mmap_digest, path, kind)))
+                    if len(pending) >= window:
+                        finish(*pending.popleft())
+                while pending:
+                    finish(*pending.popleft())
+
+            for relpath in index.paths():
+                if relpath not in seen:
+                    metrics.missing.append(os.path.join(destpath, relpath))
+                    index.remove(relpath)
+            if first and copylog is not None:
+                # before there was an index, the copy log is all there is
+                prefix = os.path.join(destpath, "")
+                rows = copylog.execute("SELECT dest FROM copied WHERE substr(dest, 1, ?) = ?", (len(prefix), prefix))
+                for (dest,) in rows:
+                    if dest[len(prefix):] not in seen:
+                        metrics.missing.append(dest)
+    finally:
+        if copylog is not None:
+            copylog.close()
+
+
+def print_results(metrics, copyplan):
+    print("------------------")
+    print("Copy Results:")
+    print(metrics)
+    for b in copyplan.backups:
+        print("------------------")
+        print("Copy Results for {}:".format(b.destpath))
+        print(b.metrics)
+
 
-        logger.info("Copying {} pictures".format(len(copyplan.groups_to_copy)))
-        for group in copyplan.groups_to_copy:
-            try_copy(metrics, copyplan, copylog, group)
+def write_metrics_json(metrics, path, copyplan = None):
+    result = metrics.to_json()
+    if copyplan is not None and copyplan.backups:
+        result["backups"] = { b.destpath: b.metrics.to_json() for b in copyplan.backups }
+    with open(os.path.expanduser(path), 'w') as f:
+        json.dump(result, f, indent=2)
 
 
 def show_info():
     pass
 
 
+def make_copyplan(args, destpath):
+    """
+    :returns: a new CopyPlan with the settings from the command line
+    """
+    copyplan = CopyPlan(lookback_days=args.days, force=args.force, maxpics=args.number)
+    copyplan.destpath = destpath
+    copyplan.copy_backend = args.copy_backend
+    copyplan.hash_algorithm = args.hash
+    copyplan.journal = args.journal
+    copyplan.clone = args.clone
+    copyplan.dedup = args.dedup
+    copyplan.max_read_mbps = args.max_read_mbps
+    copyplan.max_write_mbps = args.max_write_mbps
+    copyplan.idle_io = args.idle_io
+    copyplan.drop_cache = args.drop_cache
+    copyplan.copy_order = args.copy_order
+    copyplan.newest_first = args.newest_first
+    copyplan.pipelined = args.pipeline
+    copyplan.backup_destpaths = [os.path.expanduser(d) for d in args.also_copy_to or []]
+    if args.verify_copy:
+        copyplan.hash_algorithm = args.hash or fastcopy.DEFAULT_HASH
+        copyplan.verify_copies = True
+    return copyplan
+
+
 def make_logger(verbose):
     logger = logging.getLogger("importpics")
     level = logging.INFO
-    if args.verbose:
+    if verbose:
         level = logging.DEBUG
     logger.setLevel(level)
     logger.handlers = []
@@ -601,43 +2858,111 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(__doc__)
     parser.add_argument("--test", action="store_true", default=False, help="run unit tests")
     parser.add_argument("--info", action="store_true", default=False, help="dont cp, just show file info")
+    parser.add_argument("--compact", action="store_true", default=False, help="fold old copy logs into the copy log database and exit")
     parser.add_argument("-d", "--days", type=int, default=7, help="how many days ago to look for pictures")
     parser.add_argument("-f", "--force", action="store_true", default=False, help="copy files even if logs show they were already copied")
     parser.add_argument("-n", "--number", type=int, default=None, help="Number of pictures (not number of files) to import")
+    parser.add_argument("--newest-first", action="store_true", default=False, help="Plan the newest pictures first, and stop reading the card as soon as --number or --days is reached (-n then imports the newest pictures)")
+    parser.add_argument("--pipeline", action="store_true", default=False, help="Start copying as soon as the first pictures are planned, instead of after reading the whole card (needs --yes or --watch)")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Number of threads used to read picture metadata while planning the copy (or to hash files with --verify)")
+    parser.add_argument("--copy-jobs", type=int, default=1, help="Number of pictures to copy at the same time")
+    parser.add_argument("--copy-order", choices=COPY_ORDERS, default="physical", help="Copy the pictures in the order their data is on the card (physical, the default), or in the order they were planned (with --pipeline they are always copied as they are planned)")
+    parser.add_argument("--copy-backend", choices=sorted(fastcopy.BACKENDS.keys()), default=fastcopy.DEFAULT_BACKEND, help="How to copy each file (see fastcopy.py)")
+    parser.add_argument("--hash", nargs="?", const=fastcopy.DEFAULT_HASH, default=None, choices=fastcopy.HASH_ALGORITHMS, help="Hash each file while copying it and record the digest in the copy log (default algorithm: %(const)s)")
+    parser.add_argument("--verify-copy", action="store_true", default=False, help="Read back each copied file and compare it to the hash taken while copying (implies --hash)")
+    parser.add_argument("--clone", nargs="?", const="reflink", default=None, choices=fastcopy.CLONE_MODES, help="When the pictures are on the same filesystem as the destination (e.g. a staging folder), make reflinks (default) or hardlinks instead of copying the data; files that can't be cloned are copied")
+    parser.add_argument("--dedup", nargs="?", const="skip", default=None, choices=DEDUP_MODES, help="Look for each picture in the destination under any name (e.g. from a formatted card that reuses the file names, or the same card in another reader), and skip it (default) or hardlink it to the copy that is already there.  The copy log is checked too, so a picture that only has the same name as one copied before is copied")
+    parser.add_argument("--max-read-mbps", type=float, default=None, metavar="MB/S", help="Read at most this many MB per second while copying, from all the cards together")
+    parser.add_argument("--max-write-mbps", type=float, default=None, metavar="MB/S", help="Write at most this many MB per second while copying (to all the destinations together)")
+    parser.add_argument("--idle-io", action="store_true", default=False, help="Copy in the idle I/O class (like ionice -c 3), so other programs reading the destination come first (Linux, with the BFQ or CFQ scheduler)")
+    parser.add_argument("--drop-cache", action="store_true", default=False, help="Keep the pictures copied out of the page cache, so other programs' cached files aren't pushed out (each copy is flushed to disk first)")
+    parser.add_argument("--journal", action="store_true", default=False, help="Crash safe copying: copy to temporary names, fsync in batches, then rename")
+    parser.add_argument("--also-copy-to", action="append", default=None, metavar="DIR", help="Also copy everything to this folder, e.g. a backup disk, reading the card only once (can be repeated)")
+    parser.add_argument("--verify", nargs="?", const="", default=None, metavar="DIR", help="Check every picture in the destination (or DIR) against its digest from the last --verify, or from copying it with --hash, and exit.  Only files whose size or modification time changed are hashed again, unless --force is given")
+    parser.add_argument("--resume", action="store_true", default=False, help="Finish an interrupted --journal import without scanning the card again")
+    parser.add_argument("--metrics-json", default=None, metavar="PATH", help="Also write the metrics (timings, throughput, latency histograms) to this file as JSON")
+    parser.add_argument("--progress-interval", type=float, default=None, metavar="SECONDS", help="How often to report progress while copying (default: every second on a terminal, every 30 seconds otherwise)")
+    parser.add_argument("--no-progress", action="store_true", default=False, help="Don't report progress while copying")
+    parser.add_argument("--watch", action="store_true", default=False, help="Keep running, and import every camera card that gets mounted (without prompting, like --yes) to the configured destination")
+    parser.add_argument("--watch-dir", action="append", default=None, metavar="DIR", help="With --watch, import cards mounted under this folder (can be repeated; default: {})".format(", ".join(WATCH_PREFIXES)))
+    parser.add_argument("--max-cards", type=int, default=4, help="With --watch, how many cards to import at the same time")
     parser.add_argument("-y", "--yes", action="store_true", default=False, help="Automatically answer 'yes' to all confirmation prompts")
     parser.add_argument("-v", "--verbose", action="store_true", default=False, help="verbose logging")
     args = parser.parse_args()
+    if args.pipeline and not (args.yes or args.watch):
+        parser.error("--pipeline needs --yes (or --watch), since there is no plan to confirm")
+    for limit in [args.max_read_mbps, args.max_write_mbps]:
+        if limit is not None and limit <= 0:
+            parser.error("bandwidth limits have to be more than 0 MB/s")
 
     logger = make_logger(args.verbose)
     metrics = Metrics()
+    progress = None if args.no_progress else Progress(metrics, args.progress_interval)
 
     if args.test:
         import doctest
         doctest.testmod()
         sys.exit(0)
 
+    cfgfolder = "~/.importpics"
+    logsfolder = "~/.importpics/copylogs"
+    planfile = os.path.join(os.path.expanduser(cfgfolder), "plan.json")
+
+    if args.compact:
+        files, entries = CopyLog.compact(logsfolder)
+        print("Compacted {} copy logs ({} entries) into {}".format(files, entries, logsfolder))
+        sys.exit(0)
+
     if args.info:
         volume_list = diskutil.get_volume_list()
         volume_path = choose_volume(volume_list)
         pics = all_pics(volume_path)
-        for p in pics:
-            if p.lower().endswith(".jpg"):
-                tags = exif_tags(p)
-                print(get_dest_subfolder(tags, YYMMDD))
-                date_tags = ["Image DateTime", "EXIF DateTimeOriginal", "EXIF DateTimeDigitized"]
-                dates = { tag: str(tags[tag]) for tag in tags.keys() if tag in date_tags }
-                
-                print(["{}=={}".format(d, parse(d)) for d in dates.values()])
+        with MetadataCache.load(cfgfolder) as cache:
+            for p in pics:
+                if p.lower().endswith(".jpg"):
+                    dest_subfolder, date, _ = picture_info(p, cache)
+                    print(dest_subfolder)
+                    print(date)
         print(metrics)
         sys.exit(0)
 
-    cfgfolder = "~/.importpics"
-    logsfolder = "~/.importpics/copylogs"
     logger.info("Using copy logs in {}".format(logsfolder))
 
+    if args.verify is not None:
+        destpath = args.verify or read_destpath(cfgfolder, "importpicscfg")
+        destpath = destpath and os.path.abspath(os.path.expanduser(destpath))
+        if not destpath or not os.path.isdir(destpath):
+            logger.error("--verify needs a destination path; run an import once to choose one, or give the folder")
+            sys.exit(1)
+        verify_library(logger, metrics, destpath, logsfolder, args.jobs, args.force, args.hash)
+        print(metrics.verify_report())
+        if args.metrics_json:
+            write_metrics_json(metrics, args.metrics_json)
+        sys.exit(1 if metrics.mismatched or metrics.missing or metrics.failed else 0)
+    elif args.resume:
+        if not os.path.isfile(planfile):
+            logger.error("there is no interrupted import to resume")
+            sys.exit(1)
+        copyplan = resume_copy(logger, metrics, planfile, logsfolder, args.copy_jobs, progress)
+        metrics.end_disk_avail = diskutil.avail_space(copyplan.destpath)
+        print_results(metrics, copyplan)
+        if args.metrics_json:
+            write_metrics_json(metrics, args.metrics_json, copyplan)
+        sys.exit(0)
+    elif args.watch:
+        destpath = read_destpath(cfgfolder, "importpicscfg")
+        if destpath is None or not os.path.isdir(destpath):
+            logger.error("--watch needs a destination path; run an import without --watch once to choose one")
+            sys.exit(1)
+        logger.info("Importing to {}".format(destpath))
+        watch(logger, lambda: make_copyplan(args, destpath), logsfolder, args.watch_dir or WATCH_PREFIXES,
+            args.jobs, cfgfolder, args.copy_jobs, args.max_cards)
+        sys.exit(0)
+    elif os.path.isfile(planfile):
+        logger.warning("An interrupted import was found; it can be finished with --resume (continuing will discard it)")
+
     volume_list = diskutil.get_volume_list()
     volume_path = choose_volume(volume_list)
-    pics = all_pics(volume_path)
 
     try:
         destpath = get_destpath(logger, cfgfolder = cfgfolder, cfgfile = "importpicscfg", autoyes=args.yes)
@@ -647,12 +2972,16 @@ if __name__ == "__main__":
 
     diskavail = diskutil.avail_space(destpath)
     metrics.start_disk_avail = diskavail
-    copyplan = CopyPlan(lookback_days=args.days, force=args.force, maxpics=args.number)
+    copyplan = make_copyplan(args, destpath)
     copyplan.start_disk_avail = diskavail
-    copyplan.destpath = destpath
-    copy_pictures(logger, metrics, copyplan, logsfolder, pics, args.yes)
+    card, groups = scan_card(logger, copyplan, logsfolder, volume_path)
+    if groups is None:
+        logger.info("Nothing new on {} since it was last imported".format(volume_path))
+        sys.exit(0)
+    copy_pictures(logger, metrics, copyplan, logsfolder, groups, args.yes, args.jobs, cfgfolder, args.copy_jobs, planfile, progress)
+    remember_card(card, copyplan, metrics, logsfolder)
 
     metrics.end_disk_avail = diskutil.avail_space(destpath)
-    print("------------------")
-    print("Copy Results:")
-    print(metrics)
+    print_results(metrics, copyplan)
+    if args.metrics_json:
+        write_metrics_json(metrics, args.metrics_json, copyplan)
@@ -0,0 +1,332 @@
+"""
+Index of the files in a destination folder (the library), kept in the
+library itself as .importpics.db:  the size and modification time of each
+file, by its path relative to the library, with its digest and a partial
+digest (see fastcopy.partial_digest()) once they are known.
+
+--verify uses it to check the library for files that changed or went
+missing without hashing everything every time:  a file whose size and
+modification time are the same as when it was hashed is taken to be the
+same.
+
+--dedup uses it to find pictures that are already in the library under
+another name, e.g. from a card that was reformatted and reuses the DCF
+names:  only files of the same size and partial digest are looked at, and
+only if those match are whole files hashed.  Imports add the files they
+copy, and only the folders that changed since are scanned for others.
+"""
+import contextlib
+import os
+import sqlite3
+import threading
+
+import fastcopy
+
+DBNAME = ".importpics.db"
+COMMIT_EVERY = 256 # files added by imports between commits
+
+
+def walk_library(library):
+    """
+    Yields (path relative to the library, os.stat result) for every file in
+    the library, leaving out hidden files and folders (like the index, and
+    the temporary files of --journal).
+    """
+    stack = [""]
+    while stack:
+        folder = stack.pop()
+        try:
+            with os.scandir(os.path.join(library, folder)) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            relpath = os.path.join(folder, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(relpath)
+            elif entry.is_file(follow_symlinks=False):
+                yield relpath, entry.stat(follow_symlinks=False)
+        stack.extend(reversed(subdirs))
+
+
+class LibraryIndex:
+    """
+    SQLite backed index of the files in a library.  Safe to use from several
+    threads.
+
+    >>> import tempfile
+    >>> library = tempfile.mkdtemp()
+    >>> with LibraryIndex.load(library) as index:
+    ...     index.put("200102_nik123456/DSC_0001.JPG", 3, 10, "sha256:abcd")
+    ...     index.get("200102_nik123456/DSC_0001.JPG")
+    ...     index.get("200102_nik123456/DSC_0002.JPG") is None
+    (3, 10, 'sha256:abcd')
+    True
+    >>> with LibraryIndex.load(library) as index:
+    ...     list(index.paths())
+    ...     index.remove("200102_nik123456/DSC_0001.JPG")
+    ...     list(index.paths())
+    ['200102_nik123456/DSC_0001.JPG']
+    []
+    """
+    open_indexes = {} # library -> [LibraryIndex, number of users]
+    open_lock = threading.Lock()
+
+    def __init__(self, library):
+        self.library = library
+        self.dbfile = os.path.join(library, DBNAME)
+        self.lock = threading.Lock()
+        self.db = None
+        self.added = 0 # files added since the last commit
+
+    def __enter__(self):
+        self.db = sqlite3.connect(self.dbfile, check_same_thread=False, timeout=30)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(files)")]
+        if columns and "partial" not in columns:
+            # digests were required before there were partial digests
+            self.db.execute("ALTER TABLE files RENAME TO old_files")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                digest TEXT,
+                partial TEXT
+            ) WITHOUT ROWID""")
+        if columns and "partial" not in columns:
+            self.db.execute("INSERT INTO files (path, size, mtime, digest) SELECT path, size, mtime, digest FROM old_files")
+            self.db.execute("DROP TABLE old_files")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS folders (
+                path TEXT PRIMARY KEY,
+                mtime INTEGER NOT NULL
+            ) WITHOUT ROWID""")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(files)")]
+        if "bad" not in columns:
+            self.db.execute("ALTER TABLE files ADD COLUMN bad INTEGER NOT NULL DEFAULT 0")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_size ON files (size)")
+        self.db.commit()
+        return self
+
+    def __exit__(self, extype, exval, trace):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    def get(self, path):
+        """
+        :param path: path of the file, relative to the library
+        :returns: tuple of (size, mtime in ns, digest or None), or None if
+            the file isn't in the index
+        """
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime, digest FROM files WHERE path = ?", (path,)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def put(self, path, size, mtime, digest = None, partial = None, bad = False):
+        """
+        :param bad: the data of the file doesn't match the digest (--verify),
+            which is kept, so it is checked against it until it does again
+        """
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files (path, size, mtime, digest, partial, bad) VALUES (?, ?, ?, ?, ?, ?)",
+                (path, size, mtime, digest, partial, int(bad)))
+
+    def is_bad(self, path):
+        """
+        :returns: True if the file didn't match its digest the last time it
+            was verified
+        """
+        with self.lock:
+            row = self.db.execute("SELECT bad FROM files WHERE path = ?", (path,)).fetchone()
+        return bool(row and row[0])
+
+    def update(self, path, digest = None, partial = None):
+        """
+        Adds digests of a file that were worked out later
+        """
+        with self.lock:
+            self.db.execute("UPDATE files SET digest = coalesce(?, digest), partial = coalesce(?, partial) WHERE path = ?",
+                (digest, partial, path))
+
+    def add(self, path):
+        """
+        Adds a file an import just wrote to the library.  It is hashed when
+        it is needed:  the digest taken while copying is of the source, so
+        --verify still checks the copy against it.
+        :param path: absolute path of the file
+        """
+        st = os.stat(path)
+        self.put(os.path.relpath(path, self.library), st.st_size, st.st_mtime_ns)
+        with self.lock:
+            self.added += 1
+            if self.added >= COMMIT_EVERY:
+                self.db.commit()
+                self.added = 0
+
+    def remove(self, path):
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def paths(self):
+        """
+        Yields the path of every file in the index
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT path FROM files ORDER BY path").fetchall()
+        for row in rows:
+            yield row[0]
+
+    def count(self, hashed = False):
+        """
+        :param hashed: only count the files that have a digest
+        """
+        where = " WHERE digest IS NOT NULL" if hashed else ""
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM files" + where).fetchone()[0]
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.added = 0
+
+    def scan(self, full = False):
+        """
+        Adds the files in the library that are not in the index (or changed)
+        to it, without hashing them.  Adding, removing or renaming a file
+        changes the modification time of its folder, so only the folders
+        whose modification time changed since the last scan are looked at,
+        unless `full`.  Those are the ones imports copied to, whose files
+        are already indexed, and the ones something else changed.
+        :returns: number of files added
+        """
+        added = 0
+        stack = [""]
+        while stack:
+            folder = stack.pop()
+            path = os.path.join(self.library, folder)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                with self.lock:
+                    row = self.db.execute("SELECT mtime FROM folders WHERE path = ?", (folder,)).fetchone()
+                changed = full or row is None or row[0] != mtime
+                if folder and not changed:
+                    continue
+                with os.scandir(path) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError:
+                continue
+            subdirs = []
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                relpath = os.path.join(folder, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(relpath)
+                elif changed and entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    row = self.get(relpath)
+                    if row is None or row[0:2] != (st.st_size, st.st_mtime_ns):
+                        self.put(relpath, st.st_size, st.st_mtime_ns)
+                        added += 1
+            stack.extend(reversed(subdirs))
+            if changed:
+                with self.lock:
+                    self.db.execute("INSERT OR REPLACE INTO folders (path, mtime) VALUES (?, ?)", (folder, mtime))
+        self.commit()
+        return added
+
+    def find_duplicate(self, path, size, full = None):
+        """
+        Looks for a file in the library with the same data as path, a file
+        outside of it.  Whole files are only hashed when the sizes and
+        partial digests match.
+        :param full: dictionary of (algorithm -> digest) of the whole file at
+            path, if any are known;  the ones worked out are added to it
+        :returns: path of the duplicate relative to the library, or None
+
+        >>> import tempfile
+        >>> library, card = tempfile.mkdtemp(), tempfile.mkdtemp()
+        >>> os.makedirs(os.path.join(library, "200102_nik123456"))
+        >>> for folder, name, data in [(library, "200102_nik123456/DSC_0001.JPG", b"abc"), (card, "DSC_0009.JPG", b"abc"), (card, "DSC_0010.JPG", b"abd")]:
+        ...     with open(os.path.join(folder, name), "wb") as f:
+        ...         _ = f.write(data)
+        >>> with LibraryIndex.load(library) as index:
+        ...     index.scan(), index.scan()
+        ...     index.find_duplicate(os.path.join(card, "DSC_0009.JPG"), 3)
+        ...     index.find_duplicate(os.path.join(card, "DSC_0010.JPG"), 3) is None
+        (1, 0)
+        '200102_nik123456/DSC_0001.JPG'
+        True
+        """
+        full = {} if full is None else full
+        partial = fastcopy.partial_digest(path)
+        # files of the same size are common (uncompressed raw files always
+        # are), so only the ones whose partial digest matches, or isn't
+        # known yet, are looked at;  files that failed --verify never are
+        with self.lock:
+            candidates = self.db.execute(
+                "SELECT path, mtime, digest, partial FROM files WHERE size = ? AND (partial = ? OR partial IS NULL) AND NOT bad",
+                (size, partial)).fetchall()
+        for relpath, mtime, digest, cpartial in candidates:
+            cpath = os.path.join(self.library, relpath)
+            try:
+                st = os.stat(cpath)
+                if (st.st_size, st.st_mtime_ns) != (size, mtime):
+                    continue # changed since it was indexed
+                if cpartial is None:
+                    cpartial = fastcopy.partial_digest(cpath)
+                    self.update(relpath, partial=cpartial)
+                if cpartial != partial:
+                    continue
+                # almost certainly the same, but make sure
+                if digest is None:
+                    digest = fastcopy.mmap_digest(cpath)
+                    self.update(relpath, digest=digest)
+            except OSError:
+                continue
+            algorithm = digest.split(":", 1)[0]
+            if algorithm not in full:
+                full[algorithm] = fastcopy.mmap_digest(path, algorithm)
+            if full[algorithm] == digest:
+                return relpath
+        return None
+
+    @staticmethod
+    def exists(library):
+        """
+        :returns: True if the library has an index
+        """
+        return os.path.isfile(os.path.join(os.path.expanduser(library), DBNAME))
+
+    @staticmethod
+    def load(library):
+        return LibraryIndex(os.path.expanduser(library))
+
+    @staticmethod
+    @contextlib.contextmanager
+    def shared(library):
+        """
+        Opens the index of a library, or uses the one any other import in this
+        process copying to it at the same time (--watch) has open, since
+        SQLite only lets one connection write at a time.  It is closed when
+        the last one finishes.
+        """
+        key = os.path.abspath(os.path.expanduser(library))
+        with LibraryIndex.open_lock:
+            entry = LibraryIndex.open_indexes.get(key)
+            if entry is None:
+                entry = LibraryIndex.open_indexes[key] = [LibraryIndex.load(library).__enter__(), 0]
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with LibraryIndex.open_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del LibraryIndex.open_indexes[key]
+                    entry[0].__exit__(None, None, None)
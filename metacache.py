@@ -0,0 +1,119 @@
+"""
+Persistent cache of the metadata importpics computes from the EXIF tags of a
+picture (destination subfolder, date, and camera hash), so that scanning the
+same card again doesn't have to read the EXIF data of every file again.
+
+Entries are keyed on the absolute path of the source file and are only used
+if the size and modification time of the file still match.  The cache is
+bounded: when it grows past max_entries the least recently used entries are
+dropped.
+"""
+import datetime
+import os
+import sqlite3
+import threading
+
+DEFAULT_MAX_ENTRIES = 500000
+
+
+class MetadataCache:
+    """
+    SQLite backed cache of per-file metadata.  Safe to use from several
+    threads.
+
+    >>> import tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> dt = datetime.datetime(2020, 1, 2, 16, 11, 6)
+    >>> with MetadataCache.load(folder, max_entries=2) as cache:
+    ...     cache.put("/a.jpg", 10, 1, "200102_nik123456", dt, "nik123456")
+    ...     cache.put("/b.jpg", 10, 1, "200102_nik123456", dt, "nik123456")
+    ...     cache.get("/a.jpg", 10, 1)
+    ...     cache.get("/a.jpg", 11, 1) is None
+    ('200102_nik123456', datetime.datetime(2020, 1, 2, 16, 11, 6), 'nik123456')
+    True
+    >>> with MetadataCache.load(folder, max_entries=2) as cache:
+    ...     cache.get("/a.jpg", 10, 1)[0]
+    ...     cache.put("/c.jpg", 10, 1, "200102_nik123456", dt, "nik123456")
+    '200102_nik123456'
+    >>> with MetadataCache.load(folder, max_entries=2) as cache:
+    ...     [cache.get(p, 10, 1) is None for p in ["/a.jpg", "/b.jpg", "/c.jpg"]]
+    [False, True, False]
+    """
+    def __init__(self, dbfile, max_entries = DEFAULT_MAX_ENTRIES):
+        if max_entries < 1:
+            raise ValueError()
+        self.dbfile = dbfile
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = None
+        self.touched = set() # paths that were read from the cache this run
+        self.generation = None # last_used value for everything used this run
+
+    def __enter__(self):
+        self.db = sqlite3.connect(self.dbfile, check_same_thread=False, timeout=30)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS metadata (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                dest_subfolder TEXT NOT NULL,
+                exif_date TEXT NOT NULL,
+                cam_hash TEXT NOT NULL,
+                last_used INTEGER NOT NULL
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS metadata_lru ON metadata (last_used)")
+        last = self.db.execute("SELECT MAX(last_used) FROM metadata").fetchone()[0]
+        self.generation = (last or 0) + 1
+        return self
+
+    def __exit__(self, extype, exval, trace):
+        with self.lock:
+            self.db.executemany(
+                "UPDATE metadata SET last_used = ? WHERE path = ?",
+                [(self.generation, path) for path in self.touched],
+            )
+            self.evict()
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    def get(self, path, size, mtime):
+        """
+        :param mtime: modification time of the file, in ns
+        :returns: tuple of (dest_subfolder, exif_date, cam_hash), or None if
+            the file isn't in the cache or has changed
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT dest_subfolder, exif_date, cam_hash FROM metadata WHERE path = ? AND size = ? AND mtime = ?",
+                (path, size, mtime),
+            ).fetchone()
+            if row is None:
+                return None
+            self.touched.add(path)
+        return row[0], datetime.datetime.fromisoformat(row[1]), row[2]
+
+    def put(self, path, size, mtime, dest_subfolder, exif_date, cam_hash):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, size, mtime, dest_subfolder, exif_date.isoformat(), cam_hash, self.generation),
+            )
+
+    def evict(self):
+        """
+        Drops the least recently used entries beyond max_entries.
+        """
+        count = self.db.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute(
+                "DELETE FROM metadata WHERE path IN (SELECT path FROM metadata ORDER BY last_used, rowid LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    @staticmethod
+    def load(folder, max_entries = DEFAULT_MAX_ENTRIES):
+        folder = os.path.expanduser(folder)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        return MetadataCache(os.path.join(folder, "metadata.db"), max_entries)
@@ -0,0 +1,167 @@
+"""
+Generates synthetic camera cards for benchmarks:  a DCIM folder with DCF
+folders like 100NIKON, holding JPG+NEF pairs named DSC_0001.JPG, with real
+EXIF Make/Model/DateTime tags and a Nikon MakerNote with a serial number, so
+that importpics sorts them into the same folders it would for real pictures.
+
+The image data is random bytes, only the headers are real.
+"""
+import datetime
+import os
+import random
+import struct
+
+ASCII = 2
+LONG = 4
+UNDEFINED = 7
+
+DEFAULT_MAKE = "NIKON CORPORATION"
+DEFAULT_MODEL = "NIKON D750"
+DEFAULT_SERIAL = "3012345"
+
+
+def _ascii(tag, value):
+    data = value.encode("utf-8") + b"\x00"
+    return (tag, ASCII, len(data), data)
+
+
+def _ifd(entries, offset, endian):
+    """
+    Encodes an IFD that will be written at `offset` (relative to the TIFF
+    header), followed by the values that don't fit in the entries.
+    """
+    entries = sorted(entries)
+    table = struct.pack(endian + "H", len(entries))
+    data = b""
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    for tag, ftype, count, value in entries:
+        table += struct.pack(endian + "HHI", tag, ftype, count)
+        if len(value) <= 4:
+            table += value.ljust(4, b"\x00")
+        else:
+            table += struct.pack(endian + "I", data_offset + len(data))
+            data += value
+            if len(data) % 2:
+                data += b"\x00"
+    return table + b"\x00\x00\x00\x00" + data
+
+
+def tiff_header(taken, make = DEFAULT_MAKE, model = DEFAULT_MODEL, serial = DEFAULT_SERIAL, endian = ">"):
+    """
+    Builds a TIFF structure with IFD0 (Make, Model, DateTime) and an EXIF IFD
+    (DateTimeOriginal, DateTimeDigitized, and a type 2 Nikon MakerNote).
+    :param taken: datetime the picture was taken
+    """
+    order = b"MM\x00*" if endian == ">" else b"II*\x00"
+    dt = taken.strftime("%Y:%m:%d %H:%M:%S")
+
+    note = b"Nikon\x00\x02\x10\x00\x00" + order + struct.pack(endian + "I", 8)
+    note += _ifd([_ascii(0x001D, serial)], 8, endian)
+
+    ifd0 = [_ascii(0x010F, make), _ascii(0x0110, model), _ascii(0x0132, dt)]
+    # the EXIF IFD goes right after IFD0, whose size doesn't depend on the pointer value
+    exif_offset = 8 + len(_ifd(ifd0 + [(0x8769, LONG, 1, b"\x00" * 4)], 8, endian))
+    ifd0.append((0x8769, LONG, 1, struct.pack(endian + "I", exif_offset)))
+    exif = [_ascii(0x9003, dt), _ascii(0x9004, dt), (0x927C, UNDEFINED, len(note), note)]
+    return order + struct.pack(endian + "I", 8) + _ifd(ifd0, 8, endian) + _ifd(exif, exif_offset, endian)
+
+
+def _write_padded(path, header, size, trailer = b""):
+    with open(path, 'wb') as f:
+        f.write(header)
+        remaining = max(0, size - len(header) - len(trailer))
+        while remaining > 0:
+            chunk = min(remaining, 1024 * 1024)
+            f.write(os.urandom(chunk))
+            remaining -= chunk
+        f.write(trailer)
+
+
+def write_jpeg(path, taken, size, **exif):
+    """
+    Writes a JPEG of about `size` bytes with an APP1 EXIF segment
+    """
+    app1 = b"Exif\x00\x00" + tiff_header(taken, **exif)
+    header = b"\xff\xd8\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1
+    header += b"\xff\xdb\x00\x04\x00\x00" # an (empty) quantization table
+    _write_padded(path, header, size, b"\xff\xd9")
+
+
+def write_nef(path, taken, size, **exif):
+    """
+    Writes a TIFF based raw file of about `size` bytes
+    """
+    _write_padded(path, tiff_header(taken, **exif), size)
+
+
+def make_card(root, pictures = 100, per_folder = 50, jpeg_bytes = 100 * 1024, nef_bytes = 1024 * 1024,
+        raw = True, days = 10, cameras = 1, end = None, seed = 0, shuffle = False):
+    """
+    Creates <root>/DCIM/100NIKON/DSC_0001.JPG etc.
+
+    >>> import tempfile
+    >>> import fastexif
+    >>> root = tempfile.mkdtemp()
+    >>> files = make_card(root, pictures=3, per_folder=2, jpeg_bytes=1000, nef_bytes=2000)
+    >>> [os.path.relpath(f, root) for f in files]
+    ['DCIM/100NIKON/DSC_0001.JPG', 'DCIM/100NIKON/DSC_0001.NEF', 'DCIM/100NIKON/DSC_0002.JPG', 'DCIM/100NIKON/DSC_0002.NEF', 'DCIM/101NIKON/DSC_0003.JPG', 'DCIM/101NIKON/DSC_0003.NEF']
+    >>> tags = fastexif.read_tags(files[0])
+    >>> tags["Image Make"], tags["MakerNote SerialNumber"]
+    ('NIKON CORPORATION', '3012345')
+    >>> os.path.getsize(files[1])
+    2000
+
+    :param pictures: number of pictures (each one is a JPG, plus a NEF if raw)
+    :param per_folder: pictures per DCF folder
+    :param days: the pictures are spread evenly over this many days, ending
+        at `end` (default: now), oldest first like on a real card
+    :param cameras: number of different camera serial numbers to use
+    :param shuffle: write the pictures in a random order, so that where they
+        are on the disk doesn't follow their names (like on a card that has
+        been written to and had pictures deleted for a while)
+    :returns: list of the files created, in name order
+    """
+    rng = random.Random(seed)
+    end = end or datetime.datetime.now().replace(microsecond=0)
+    span = datetime.timedelta(days=days).total_seconds()
+    order = list(range(pictures))
+    if shuffle:
+        rng.shuffle(order)
+    written = {}
+    for i in order:
+        folder = os.path.join(root, "DCIM", "{}NIKON".format(100 + i // per_folder))
+        os.makedirs(folder, exist_ok=True)
+        taken = end - datetime.timedelta(seconds=int(span * (pictures - 1 - i) / max(1, pictures - 1)))
+        exif = {"serial": str(int(DEFAULT_SERIAL) + rng.randrange(cameras))}
+        base = os.path.join(folder, "DSC_{:04d}".format(i % 9999 + 1))
+        write_jpeg(base + ".JPG", taken, jpeg_bytes, **exif)
+        written[i] = [base + ".JPG"]
+        if raw:
+            write_nef(base + ".NEF", taken, nef_bytes, **exif)
+            written[i].append(base + ".NEF")
+        mtime = taken.timestamp()
+        for f in written[i]:
+            os.utime(f, (mtime, mtime))
+    return [f for i in range(pictures) for f in written[i]]
+
+
+def make_collisions(destpath, files, dest_subfolder, count, seed = 0):
+    """
+    Puts files with the same names, but different sizes, in the destination
+    folders some of the pictures will be copied to, so that importpics has to
+    use alternate folders for them.
+    :param files: files on the card
+    :param dest_subfolder: function returning the destination subfolder of a
+        file, e.g. lambda f: importpics.picture_info(f)[0]
+    :returns: list of the files created
+    """
+    rng = random.Random(seed)
+    created = []
+    for f in rng.sample(files, min(count, len(files))):
+        folder = os.path.join(destpath, dest_subfolder(f))
+        os.makedirs(folder, exist_ok=True)
+        dest = os.path.join(folder, os.path.basename(f))
+        with open(dest, 'wb') as fh:
+            fh.write(b"not the same picture")
+        created.append(dest)
+    return created